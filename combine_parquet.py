@@ -1,5 +1,70 @@
 import argparse
-import pandas as pd
+from collections import Counter
+import pyarrow as pa
+import pyarrow.parquet as pq
+import util_common as util
+
+BATCH_SIZE = 64 * 1024  # rows read from an input at a time
+LOCATION_COLUMN = "location"
+
+def unified_schema(parquet_files, tags):
+    # Schema holding the columns of every input, widened as util.unified_schema does, followed by the tag columns
+    schemas = []
+    for parquet_file in parquet_files:
+        schema = parquet_file.schema_arrow.remove_metadata()
+        # pandas' stored index is not data, and pd.concat(ignore_index=True) dropped it too
+        for name in schema.names:
+            if name.startswith("__index_level_") or name in tags:
+                schema = schema.remove(schema.get_field_index(name))
+        schemas.append(schema)
+    schema = util.unified_schema(schemas)
+    for name in tags:
+        schema = schema.append(pa.field(name, pa.string()))
+    return schema
+
+def location_counts(parquet_file, column=LOCATION_COLUMN):
+    # Rows per value of column, from the row group statistics where a row group holds one value,
+    # which is the case for per-location tables. Other row groups have only that column read.
+    counts = Counter()
+    metadata = parquet_file.metadata
+    paths = [metadata.schema.column(i).path for i in range(metadata.num_columns)]
+    if column not in paths:
+        return counts
+    column_index = paths.index(column)
+    for row_group in range(metadata.num_row_groups):
+        row_group_metadata = metadata.row_group(row_group)
+        statistics = row_group_metadata.column(column_index).statistics
+        if (statistics is not None and statistics.has_min_max and statistics.has_null_count
+                and statistics.null_count == 0 and statistics.min == statistics.max):
+            counts[statistics.min] += row_group_metadata.num_rows
+            continue
+        values = parquet_file.read_row_group(row_group, columns=[column]).column(0).drop_null()
+        value_counts = values.value_counts()
+        for value, count in zip(value_counts.field("values").to_pylist(), value_counts.field("counts").to_pylist()):
+            counts[value] += count
+    return counts
+
+def combine(inputs, output, tags):
+    # Streams the record batches of every input into one output file, conformed to the unified schema
+    parquet_files = [pq.ParquetFile(p) for p in inputs]
+    schema = unified_schema(parquet_files, tags)
+    data_columns = [name for name in schema.names if name not in tags]
+    counts = Counter()
+    with pq.ParquetWriter(output, schema) as writer:
+        for parquet_file in parquet_files:
+            for batch in parquet_file.iter_batches(batch_size=BATCH_SIZE, columns=[n for n in parquet_file.schema_arrow.names if n in data_columns]):
+                table = util.conform_table(pa.Table.from_batches([batch]), schema)
+                for name, value in tags.items():
+                    table = table.set_column(schema.get_field_index(name), name, pa.array([value] * table.num_rows, pa.string()))
+                writer.write_table(table)
+            counts.update(location_counts(parquet_file))
+    return counts
+
+def parse_tag(text):
+    name, separator, value = text.partition("=")
+    if not separator or not name:
+        raise argparse.ArgumentTypeError(f"Tags are given as NAME=VALUE, got '{text}'")
+    return name, value
 
 def main():
     parser = argparse.ArgumentParser(
@@ -13,25 +78,23 @@ def main():
         default="combined.parquet",
         help="Output Parquet file path (default: combined.parquet)"
     )
+    parser.add_argument(
+        "-t", "--tag",
+        action="append",
+        type=parse_tag,
+        default=[],
+        metavar="NAME=VALUE",
+        help="Add a column NAME with VALUE on every row, e.g. --tag experiment_name=quil_5day_clean (repeatable)"
+    )
     args = parser.parse_args()
 
-    # Read all inputs into DataFrames
-    dfs = [pd.read_parquet(p) for p in args.inputs]
-
-    # Concatenate (headers preserved only once)
-    combined = pd.concat(dfs, ignore_index=True)
-
-    # Add tags
-    combined["experiment_name"] = "quil_5day_clean"
-
-    # Write out
-    combined.to_parquet(args.output)
+    # Stream all inputs into the output, never holding more than a batch of rows
+    counts = combine(args.inputs, args.output, dict(args.tag))
     print(f"✅ Combined {len(args.inputs)} files → {args.output}")
 
-    counts = combined["location"].value_counts()
     print("📊 Counts per location:")
-    for loc, cnt in counts.items():
+    for loc, cnt in counts.most_common():
         print(f"  - {loc}: {cnt}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
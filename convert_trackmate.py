@@ -21,7 +21,7 @@ Convert TrackMate outputs into a format compatable for Loon software.
 Inputs: 
 - A CSV file from TrackMate
     - Must currently include 'LABEL', 'FRAME', 'POSITION_X', 'POSITION_Y' columns
-- A folder containing ROI files from TrackMate
+- A folder, or an ImageJ RoiSet.zip, containing ROI files from TrackMate
 
 Process:
 - Read the CSV file, remove unnecessary rows / columns, sort by frame
@@ -38,15 +38,17 @@ Outputs:
 """
 
 import os
+import argparse
+import contextlib
+import io
 import tkinter as tk
 from tkinter import filedialog, messagebox
 import fnmatch
 from matlab_to_all import QUIET_MODE
 import util_common as util
-from roifile import ImagejRoi
-from geojson import Feature, Polygon, FeatureCollection, dumps
-from typing import Union, List
-import pandas as pd
+from itertools import groupby
+from typing import List
+import pyarrow.parquet as pq
 import re
 import sys
 import threading
@@ -66,26 +68,23 @@ location = "location"
 # New track ID column
 loon_track = "loon_track"
 
-def main(csv_filename, roi_folder, output_folder, metadata_csv=None, metadata_parquet=None, segmentations_folder=None):
-    # load csv into df
-    df = pd.read_csv(csv_filename)
+# Label columns stored as categoricals when compacting
+label_columns = [label, loon_track, "parent", inputLabel]
 
-    # delete extra rows with metadata
-    df = df.drop([0, 1, 2])
-    # df = df.infer_objects() # this made everything an object, but I would've expected this to work
+# Types of the columns the conversion relies on, the others are inferred
+column_dtypes = {inputLabel: str, frame: "int64", position_x: "float64", position_y: "float64"}
 
-    # reload and clean up temporary file.
-    temp_csv = os.path.join(output_folder, "temp.csv")
-    df.to_csv(temp_csv, index=False)
-    df = pd.read_csv(temp_csv)
-    os.remove(temp_csv)  # Clean up the temporary file
+def main(csv_filename, roi_folder, output_folder, metadata_csv=None, metadata_parquet=None, segmentations_folder=None, workers=1, incremental=False, precision=util.DEFAULT_PRECISION, packed=False, compact=False, tolerance=0.0):
+    # load csv into df, skipping the extra rows with metadata.
+    # MANUAL_SPOT_COLOR is all empty and is causing problems, so it is never loaded.
+    df = util.read_trackmate_csv(csv_filename, column_dtypes, ["MANUAL_SPOT_COLOR"])
 
     # sort by frame
     # convert frame to int
     df[frame] = df[frame] + 1
     df = df.sort_values(by=[frame])
 
-    df = df.rename(columns={"LOC": location})
+    df.rename(columns={"LOC": location}, inplace=True)
 
     # check if the required columns are present
     required_columns = [frame, position_x, position_y]
@@ -107,12 +106,8 @@ def main(csv_filename, roi_folder, output_folder, metadata_csv=None, metadata_pa
     df[position_x] = df[position_x] * scaling_factor
     df[position_y] = df[position_y] * scaling_factor
 
-    # remove MANUAL_SPOT_COLOR column since it is all empty and is causing problems.
-    if "MANUAL_SPOT_COLOR" in df.columns:
-        df = df.drop(columns=["MANUAL_SPOT_COLOR"])
-
     # create new column for the track ID by dropping the spot ID from the label column
-    df[loon_track] = df[label].apply(lambda x: os.path.splitext(x)[0])
+    df[loon_track] = util.strip_extension(df[label])
 
     # move new column to first position
     cols = list(df.columns)
@@ -125,7 +120,13 @@ def main(csv_filename, roi_folder, output_folder, metadata_csv=None, metadata_pa
     df = infer_parent_from_id(df, output_csv_filename)
 
     geojson_output_folder = segmentations_folder if segmentations_folder else os.path.join(output_folder, "segmentations")
-    roi_to_geojson(df, roi_folder, geojson_output_folder)
+    roi_to_geojson(df, roi_folder, geojson_output_folder, workers, incremental, precision, packed)
+
+    # labels repeated on every row of a track are stored once per value, floats as float32 within tolerance.
+    # Integer types are kept. What still differs between the locations of a batch (the dictionary index type,
+    # float32 against float64) is widened once for the whole batch by run_batch_conversion.
+    if compact:
+        df = util.compact_table(df, label_columns, tolerance, downcast_integers=False)
 
     parquet_path = metadata_parquet if metadata_parquet else os.path.join(output_folder, "metadata.parquet")
     df.to_parquet(parquet_path, index=False)
@@ -135,22 +136,11 @@ def main(csv_filename, roi_folder, output_folder, metadata_csv=None, metadata_pa
 # Given a dataframe with a track label column, create a parent column by infering parent values from labels.
 def infer_parent_from_id(df, output_csv):
     # Add a new column 'parent' based on the 'LABEL' column
-    def calculate_parent(child_label):
-        if isinstance(child_label, str):
-            if "." not in child_label:
-                return child_label
-            parent = child_label[:-1].rstrip(".")
-            # check if parent exists in the LABEL column
-            if parent not in df[label].values:
-                # If parent does not exist, return the original label
-                return child_label
-        return parent
-
-    df["parent"] = df[label].apply(calculate_parent)
-    # Reorder columns so 'parent' is the second column
-    cols = list(df.columns)
-    cols.insert(1, cols.pop(cols.index("parent")))
-    df = df[cols]
+    # as the second column
+    parent = util.infer_parent_labels(df[label])
+    if "parent" in df.columns:
+        df.drop(columns=["parent"], inplace=True)
+    df.insert(1, "parent", parent)
 
     util.ensure_directory_exists(output_csv)
     # Save the updated DataFrame to a new CSV file
@@ -160,24 +150,32 @@ def infer_parent_from_id(df, output_csv):
 
 ######################
 
-# Given a folder of ROI files and a dataframe, outputs a folder of GeoJson files
-def roi_to_geojson(df, roi_folder, output_folder):
+# Given a folder (or RoiSet.zip) of ROI files and a dataframe, outputs a folder of GeoJson files
+def roi_to_geojson(df, roi_folder, output_folder, workers=1, incremental=False, precision=util.DEFAULT_PRECISION, packed=False):
     util.ensure_directory_exists(output_folder)
     util.msg_header("Finding ROI files", QUIET_MODE)
 
+    # ROI files are read from an ImageJ RoiSet.zip, or from a folder
+    archive = roi_folder if util.is_roi_archive(roi_folder) else None
+
     pattern = "Track_*.roi"
     filename_list = []
-    # Recursively searches for roi files matching 'pattern'
-    for root, _, files in os.walk(roi_folder):
-        path = root.replace(roi_folder, "", 1)
-        for name in fnmatch.filter(files, pattern):
-            filename_list.append((path, name))
+    if archive is not None:
+        # All members are listed from the archive's central directory
+        filename_list = util.list_roi_archive(archive, pattern)
+    else:
+        # Recursively searches for roi files matching 'pattern'
+        for root, _, files in os.walk(roi_folder):
+            path = os.path.relpath(root, roi_folder)
+            path = "" if path == os.curdir else path
+            for name in fnmatch.filter(files, pattern):
+                filename_list.append((path, name))
 
-    # Sort the ROI filenames by folder, frame number, and track ID.
-    filename_list.sort(key=lambda f: (f[0], parse_frame(f[1], df), parse_id(f[1])))
+    # Resolve the frame of every ROI filename, sorted by folder, frame number, and track ID.
+    filename_list = parse_frames(filename_list, df)
 
     # Log the number of files found
-    filename_stats = get_filename_stats(filename_list, df)
+    filename_stats = get_filename_stats(filename_list)
     # Only print high-level status
     util.msg(
         "        ████████████████████ 100.00%, {} of {} files. {} of {} frames.".format(
@@ -188,17 +186,38 @@ def roi_to_geojson(df, roi_folder, output_folder):
     )
 
 
-    feature_list = []
-    last_frame = -1
     last_path = ""
     file_count = 0
     folder_count = 0
 
-    # For each ROI file ... 
-    for path, name in filename_list:
+    # Group the ROI files by folder and frame. Each frame is decoded and serialized as one unit of work,
+    # in a process pool when workers > 1, and written here in manifest order.
+    frame_groups = [
+        (path, frame, [(util.roi_file(roi_folder, path, name, archive), parse_id(name)) for _, _, name in group])
+        for (path, frame), group in groupby(filename_list, key=lambda f: (f[0], f[1]))
+    ]
+
+    # With incremental, frames whose ROI files are unchanged since the last run are not converted again.
+    manifest = None
+    if incremental:
+        manifest = util.ConversionManifest(
+            os.path.join(output_folder, util.MANIFEST_FILENAME), settings={"precision": precision, "packed": packed}
+        )
+    is_current = [
+        manifest is not None
+        and manifest.is_current(
+            os.path.join(path, "frames", str(frame)), *util.roi_inputs([f for f, _ in roi_files], archive)
+        )
+        for path, frame, roi_files in frame_groups
+    ]
+    results = util.ordered_map(
+        util.convert_roi_frame,
+        [(frame, roi_files, archive, precision) for (_, frame, roi_files), current in zip(frame_groups, is_current) if not current],
+        workers,
+    )
 
-        # 
-        frame = parse_frame(name, df)
+    # For each frame of ROI files ...
+    for (path, frame, roi_files), current in zip(frame_groups, is_current):
 
         # Check if we're in a new folder; if so, update folder count and print a header.
         if path != last_path:
@@ -212,48 +231,34 @@ def roi_to_geojson(df, roi_folder, output_folder):
                 QUIET_MODE,
             )
             file_count = 0
-        file_count += 1
-
-        # When a new frame is encountered, export the collected features for the previous frame.
-        if last_frame != frame and last_frame != -1:
-            export(
-                feature_list,
-                os.path.join(output_folder, last_path, "frames"),
-                str(last_frame),
-            )
-            feature_list = []
+        file_count += len(roi_files)
 
-        # Update the last processed frame and folder path trackers.
-        last_frame = frame
+        # Update the last processed folder path tracker.
         last_path = path
 
-        # Construct the full path to the ROI file and parse its cell ID.
-        filename = os.path.join(roi_folder, path, name)
-        cell_id = parse_id(name)
-        # Read the ROI file and convert its coordinates into a polygon feature.
-        roi = ImagejRoi.fromfile(filename)
-        outer_polygon_coords = roi.coordinates().tolist()
-        outer_polygon_coords.append(
-            outer_polygon_coords[0]
-        )  # add beginning to end to close loop
-        feature = Feature(
-            geometry=Polygon([outer_polygon_coords]),
-            properties={"id": cell_id, "frame": frame},
-            bbox=[roi.left, roi.bottom, roi.right, roi.top],
-        )
-        # Export the individual cell feature into the corresponding folder.
+        # Skip frames a previous run already converted.
+        if current:
+            continue
+        cell_jsons = next(results)
+
+        # Export the individual cell features into the corresponding folder,
+        # and stream the same json into the FeatureCollection of the whole frame.
         # Export in format frame-cell_id
         # Example: 26-73_Track_965.b.json
-        export(
-            feature,
-            os.path.join(output_folder, last_path, "cells"),
-            "{}-{}".format(str(frame), cell_id),
+        # When packed, the cells are only indexed by their byte range in the frame's collection.
+        output_paths = util.export_frame_cells(
+            os.path.join(output_folder, path),
+            frame,
+            [(cell_id, cell_json) for (_, cell_id), cell_json in zip(roi_files, cell_jsons)],
+            OVERWRITE,
+            packed,
         )
-        feature_list.append(feature)
-    # Export any remaining features for the last processed frame.
-    export(
-        feature_list, os.path.join(output_folder, last_path, "frames"), str(last_frame)
-    )
+        if manifest is not None:
+            input_paths, extra = util.roi_inputs([f for f, _ in roi_files], archive)
+            manifest.record(os.path.join(path, "frames", str(frame)), input_paths, output_paths, extra)
+
+    if manifest is not None:
+        manifest.save()
 
     # Finalize the output by returning carriage and printing the completion message.
     util.return_carriage(QUIET_MODE)
@@ -263,52 +268,23 @@ def roi_to_geojson(df, roi_folder, output_folder):
 
 
 # Returns the count and frames of filenames.
-def get_filename_stats(filename_list: List, df) -> dict:
+def get_filename_stats(filename_list: List) -> dict:
     filename_stats = {}
-    for path, name in filename_list:
-        frame = parse_frame(name, df)
+    for path, frame, name in filename_list:
         if path not in filename_stats:
             filename_stats[path] = {"count": 0, "frames": 0}
         filename_stats[path]["count"] += 1
         filename_stats[path]["frames"] = max(filename_stats[path]["frames"], frame)
     return filename_stats
 
-
-def feature_list_to_json(feature_list: List) -> str:
-    feature_collection = FeatureCollection(feature_list)
-    return dumps(feature_collection)
-
-
-def feature_to_json(feature: Feature) -> str:
-    return dumps(feature)
-
-# Export ROI data
-def export(data: Union[Feature, List], full_path: str, name: str):
-    # If data is a single feature, convert to JSON
-    if isinstance(data, Feature):
-        data = feature_to_json(data)
-    # Otherwise convert feature list to FeatureCollection JSON
-    else:
-        data = feature_list_to_json(data)
-    util.export_file(data, full_path, name, OVERWRITE)
-    return
-
-# Given a filename and df, extract unique frame number.
-def parse_frame(filename: str, df) -> int:
-    # Remove file extension from filename
-    name_base = os.path.splitext(filename)[0]
-    # Get the track ID and cell index from the name_base
-    if "-" not in name_base:
-        name_base = name_base + "-0" 
-    track_id, cell_index = name_base.split("-")
-
-    # Find the track based on track id, sort by frame
-    track = df.loc[df[inputLabel] == track_id]
-    track = track.sort_values(by=[frame])
-    # Find the nth (cell_index) frame for this track
-    track_frame = track.iloc[int(cell_index)][frame]
-    
-    return int(track_frame)
+# Given (path, filename) pairs and df, returns (path, frame, filename) sorted by folder, frame number, and track ID.
+def parse_frames(filename_list: List, df) -> List:
+    # Group the table by track once, then resolve every filename's frame in one pass
+    frame_index = util.TrackFrameIndex(df, inputLabel, frame)
+    frames = frame_index.resolve([name for _, name in filename_list])
+    manifest = [(path, int(f), name) for (path, name), f in zip(filename_list, frames)]
+    manifest.sort(key=lambda m: (m[0], m[1], parse_id(m[2])))
+    return manifest
 
 # Given a filename, returns the track_id
 def parse_id(filename: str) -> int:
@@ -324,6 +300,100 @@ def parse_id(filename: str) -> int:
     return final_cell_id
 
 
+######################
+
+# Converts one location (subfolder). Returns (sub, parquet path, error message, console output).
+# Runs in a worker process when converting in parallel, so its console output is captured there
+# and returned for the parent process to print.
+def convert_location(sub, csv_file, roi_folder, output_folder, capture_output=False, incremental=False, precision=util.DEFAULT_PRECISION, packed=False, compact=False, tolerance=0.0):
+    # Create output folder for this location
+    out_location_folder = os.path.join(output_folder, sub)
+    os.makedirs(out_location_folder, exist_ok=True)
+    out_metadata_csv = os.path.join(out_location_folder, "metadata.csv")
+    out_segmentations = os.path.join(out_location_folder, "segmentations")
+    # Parquet goes to temp file to save memory and is appended to the master file later
+    out_metadata_parquet = os.path.join(output_folder, f"_tmp_{sub}.parquet")
+    captured = io.StringIO()
+    try:
+        with contextlib.ExitStack() as stack:
+            if capture_output:
+                stack.enter_context(contextlib.redirect_stdout(captured))
+                stack.enter_context(contextlib.redirect_stderr(captured))
+            print(f"Processing '{sub}'...\n")
+            main(csv_file, roi_folder, out_location_folder, out_metadata_csv, out_metadata_parquet, out_segmentations, incremental=incremental, precision=precision, packed=packed, compact=compact, tolerance=tolerance)
+    except Exception as e:
+        return sub, None, str(e), captured.getvalue()
+    return sub, out_metadata_parquet, None, captured.getvalue()
+
+# Converts every location (subfolder) of input_folder, up to 'workers' at a time, into output_folder.
+# A failing location is reported and skipped. Once every location is converted, their tables are appended to
+# the master metadata.parquet one at a time, each as its own row group, so the combined table is never held
+# in memory. The master's schema holds the columns of every location, widened to fit all of them, and the
+# metadata_dataset files are written with it too.
+# With incremental, only the frames whose ROI files changed since the last run are converted.
+# With dataset, each location is also written to the metadata_dataset folder, partitioned by location.
+def run_batch_conversion(input_folder, output_folder, workers=1, incremental=False, precision=util.DEFAULT_PRECISION, packed=False, dataset=False, frame_bucket_size=0, compact=False, tolerance=0.0):
+    # From the input, get each location (subfolder) and find its CSV file and ROI folder
+    subfolders = sorted(f for f in os.listdir(input_folder) if os.path.isdir(os.path.join(input_folder, f)))
+    locations = []
+    for sub in subfolders:
+        sub_path = os.path.join(input_folder, sub)
+        csv_files = [f for f in os.listdir(sub_path) if f.lower().endswith('.csv')]
+        roi_folders = [f for f in os.listdir(sub_path) if (os.path.isdir(os.path.join(sub_path, f)) or f.lower().endswith('.zip')) and 'roi' in f.lower()]
+        if not csv_files or not roi_folders:
+            print(f"Skipping '{sub}': missing CSV or ROI folder\n")
+            continue
+        csv_file = os.path.join(sub_path, csv_files[0])
+        roi_folder = os.path.join(sub_path, roi_folders[0])
+        locations.append((sub, csv_file, roi_folder, output_folder, workers > 1, incremental, precision, packed, compact, tolerance))
+
+    print(f"Processing {len(locations)} locations with {workers} worker(s)...\n")
+    master_parquet = os.path.join(output_folder, "metadata.parquet")
+    dataset_folder = os.path.join(output_folder, "metadata_dataset")
+    converted = []
+    for sub, parquet_path, error, output in util.ordered_map(convert_location, locations, workers):
+        if output:
+            print(output, end="")
+        if error is not None:
+            print(f"Error in '{sub}': {error}\n")
+            continue
+        converted.append((sub, parquet_path))
+
+    writer = None
+    combined_count = 0
+    try:
+        if converted:
+            schema = util.unified_schema([pq.read_schema(parquet_path) for _, parquet_path in converted])
+            writer = pq.ParquetWriter(master_parquet, schema)
+        for sub, parquet_path in converted:
+            try:
+                # every location is written with the batch's schema, so a column is float32 only if it is in all of them
+                table = util.conform_table(pq.read_table(parquet_path), writer.schema)
+                # the dataset is written first, so a location that fails there is not appended to the master file
+                if dataset:
+                    util.write_partitioned_dataset(table, dataset_folder, location, frame, frame_bucket_size, basename=sub)
+                writer.write_table(table, row_group_size=max(1, table.num_rows))
+            except Exception as e:
+                if dataset:
+                    # a location is in both the master file and the dataset, or in neither
+                    util.remove_dataset_files(dataset_folder, sub)
+                print(f"Error combining '{sub}', kept {parquet_path}: {e}\n")
+                continue
+            combined_count += 1
+            # Remove temp parquet file
+            try:
+                os.remove(parquet_path)
+            except Exception:
+                pass
+            print(f"Done: {sub}\n")
+    finally:
+        if writer is not None:
+            writer.close()
+    if combined_count:
+        print(f"✅ Combined {combined_count} files → {master_parquet}")
+    print("\nBatch conversion complete!\n")
+    return
+
 ######################
 def run_gui():
     root = tk.Tk()
@@ -349,7 +419,7 @@ def run_gui():
     instructions = (
         "    Each sub-folder should represent a location and contain:\n"
         "       - A CSV file exported from TrackMate\n"
-        "       - A folder containing ROI files (name contains 'roi')\n"
+        "       - A folder or RoiSet.zip of ROI files (name contains 'roi')\n"
         "\n"
         "    Example:\n"
         "       input /\n"
@@ -373,6 +443,9 @@ def run_gui():
 
     input_var = tk.StringVar()
     output_var = tk.StringVar()
+    workers_var = tk.StringVar(value=str(os.cpu_count() or 1))
+    incremental_var = tk.BooleanVar(value=False)
+    packed_var = tk.BooleanVar(value=False)
     frame = tk.Frame(root, bg="white")
     frame.pack(pady=16)
 
@@ -384,6 +457,12 @@ def run_gui():
     tk.Entry(frame, textvariable=output_var, width=44, font=entry_font, bg="#f8f8f8", fg="#222").grid(row=1, column=1, padx=6, pady=8)
     tk.Button(frame, text="Browse", command=lambda: output_var.set(filedialog.askdirectory(title="Select Output Folder")), font=button_font, bg="white", fg="#222", activebackground="#f5f5f5", activeforeground="#111", bd=0, highlightthickness=0, highlightbackground="white").grid(row=1, column=2, padx=6, pady=8)
 
+    # Number of locations converted at the same time
+    tk.Label(frame, text="Workers:", font=label_font, bg="white", fg="#222").grid(row=2, column=0, sticky="e", padx=6, pady=8)
+    tk.Spinbox(frame, from_=1, to=os.cpu_count() or 1, textvariable=workers_var, width=6, font=entry_font, bg="#f8f8f8", fg="#222").grid(row=2, column=1, sticky="w", padx=6, pady=8)
+    tk.Checkbutton(frame, text="Only convert changes since the last run", variable=incremental_var, font=label_font, bg="white", fg="#222", activebackground="white").grid(row=3, column=1, sticky="w", padx=6, pady=8)
+    tk.Checkbutton(frame, text="Pack the cells of each frame into one file", variable=packed_var, font=label_font, bg="white", fg="#222", activebackground="white").grid(row=4, column=1, sticky="w", padx=6, pady=8)
+
     # Output section (hidden until Convert is clicked)
     output_frame = tk.Frame(root, bg="white")
     text_box = tk.Text(output_frame, wrap=tk.NONE, height=14, state=tk.DISABLED, font=text_font, bg="white", fg="#222", insertbackground="#222")
@@ -422,52 +501,9 @@ def run_gui():
     util.msg_header = gui_msg_header
 
     # Function to run batch conversion in a separate thread
-    def run_batch_conversion_thread(input_folder, output_folder):
+    def run_batch_conversion_thread(input_folder, output_folder, workers, incremental, packed):
         try:
-            # From the input, get each location (subfolder) and process each one
-            subfolders = [f for f in os.listdir(input_folder) if os.path.isdir(os.path.join(input_folder, f))]
-            parquet_paths = []
-            # For this location ...
-            for sub in subfolders:
-                sub_path = os.path.join(input_folder, sub)
-                # Find CSV file and ROI folder in sub_path
-                csv_files = [f for f in os.listdir(sub_path) if f.lower().endswith('.csv')]
-                roi_folders = [f for f in os.listdir(sub_path) if os.path.isdir(os.path.join(sub_path, f)) and 'roi' in f.lower()]
-                if not csv_files or not roi_folders:
-                    print(f"Skipping '{sub}': missing CSV or ROI folder\n")
-                    continue
-                csv_file = os.path.join(sub_path, csv_files[0])
-                roi_folder = os.path.join(sub_path, roi_folders[0])
-                # Create output folder for this location
-                out_location_folder = os.path.join(output_folder, sub)
-                os.makedirs(out_location_folder, exist_ok=True)
-                out_metadata_csv = os.path.join(out_location_folder, "metadata.csv")
-                out_segmentations = os.path.join(out_location_folder, "segmentations")
-                # Parquet goes to temp file to save memory and then combined later
-                out_metadata_parquet = os.path.join(output_folder, f"_tmp_{sub}.parquet")
-
-                # Finally, process the CSV and ROI files for this location
-                print(f"Processing '{sub}'...\n")
-                try:
-                    main(csv_file, roi_folder, out_location_folder, out_metadata_csv, out_metadata_parquet, out_segmentations)
-                    parquet_paths.append(out_metadata_parquet)
-                    print(f"Done: {sub}\n")
-                except Exception as e:
-                    print(f"Error in '{sub}': {e}\n")
-            # Combine all temp parquet files into master metadata.parquet
-            if parquet_paths:
-                dfs = [pd.read_parquet(p) for p in parquet_paths]
-                combined = pd.concat(dfs, ignore_index=True)
-                master_parquet = os.path.join(output_folder, "metadata.parquet")
-                combined.to_parquet(master_parquet)
-                print(f"✅ Combined {len(parquet_paths)} files → {master_parquet}")
-                # Remove temp parquet files
-                for p in parquet_paths:
-                    try:
-                        os.remove(p)
-                    except Exception:
-                        pass
-            print("\nBatch conversion complete!\n")
+            run_batch_conversion(input_folder, output_folder, workers, incremental, packed=packed)
             root.after(0, lambda: messagebox.showinfo("Success", "Batch conversion complete!"))
         except Exception as e:
             print(f"An error occurred:\n{e}\n")
@@ -475,13 +511,18 @@ def run_gui():
             root.after(0, lambda msg=error_message: messagebox.showerror("Error", msg))
 
     # Function to run the batch conversion when Convert button is clicked
-    def run_batch_conversion():
+    def on_convert():
         # Initialize
         input_folder = input_var.get()
         output_folder = output_var.get()
         if not input_folder or not output_folder:
             messagebox.showerror("Missing Input", "Please select both input and output folders.")
             return
+        try:
+            workers = max(1, int(workers_var.get()))
+        except ValueError:
+            messagebox.showerror("Invalid Workers", "Please enter a whole number of workers.")
+            return
         # Show and initialize the console output box
         show_output_box()
         sys.stdout = StdoutRedirector(text_box)
@@ -490,12 +531,66 @@ def run_gui():
         text_box.delete(1.0, tk.END)
         text_box.config(state=tk.DISABLED)
         # Finally start the batch conversion in a separate thread
-        threading.Thread(target=run_batch_conversion_thread, args=(input_folder, output_folder), daemon=True).start()
+        threading.Thread(target=run_batch_conversion_thread, args=(input_folder, output_folder, workers, incremental_var.get(), packed_var.get()), daemon=True).start()
 
     # Convert button clicked
-    tk.Button(root, text="Convert", command=run_batch_conversion, font=button_font, bg="white", fg="#222", activebackground="#f5f5f5", activeforeground="#111", bd=0, highlightthickness=0, highlightbackground="white").pack(pady=24)
+    tk.Button(root, text="Convert", command=on_convert, font=button_font, bg="white", fg="#222", activebackground="#f5f5f5", activeforeground="#111", bd=0, highlightthickness=0, highlightbackground="white").pack(pady=24)
     root.mainloop()
 
 ######################
 if __name__ == "__main__":
-    run_gui()
+    parser = argparse.ArgumentParser(
+        description="Convert TrackMate locations to Loon data. Opens the GUI when no folders are given."
+    )
+    parser.add_argument("input_folder", nargs="?", help="Folder with one sub-folder per location")
+    parser.add_argument("output_folder", nargs="?", help="Path to the output folder")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of locations converted at the same time (default: 1)",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only convert the frames whose ROI files changed since the last run",
+    )
+    parser.add_argument(
+        "--precision",
+        type=int,
+        default=util.DEFAULT_PRECISION,
+        help="Decimals kept in segmentation coordinates, 0 writes integers (default: {})".format(util.DEFAULT_PRECISION),
+    )
+    parser.add_argument(
+        "--packed",
+        action="store_true",
+        help="Write the cells of each frame into one file with a byte range index, instead of one file per cell",
+    )
+    parser.add_argument(
+        "--dataset",
+        action="store_true",
+        help="Also write the metadata as a Parquet dataset partitioned by location, with statistics and page indexes",
+    )
+    parser.add_argument(
+        "--frame-bucket",
+        type=int,
+        default=0,
+        help="With --dataset, also partition each location by buckets of this many frames (default: 0, no buckets)",
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="Store label columns as categoricals and numbers in smaller types in the metadata Parquet",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.0,
+        help="With --compact, largest change allowed when storing a float column as float32 (default: 0, exact)",
+    )
+    args = parser.parse_args()
+
+    if args.input_folder and args.output_folder:
+        run_batch_conversion(args.input_folder, args.output_folder, args.workers, args.incremental, args.precision, args.packed, args.dataset, args.frame_bucket, args.compact, args.tolerance)
+    else:
+        run_gui()
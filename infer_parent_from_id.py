@@ -1,5 +1,6 @@
 import pandas as pd
 import argparse
+import util_common as util
 
 """
 Given an input csv file. Load the csv file and add a new column 'parent' based on the 'LABEL' column.
@@ -7,27 +8,12 @@ The 'parent' column should calculated by removing last character from the 'LABEL
 the trailing '.' if it is there.
 """
 
-REFERENCE_TABLE = "./in/totally_final_version.csv"
-df = pd.read_csv(REFERENCE_TABLE)
-
-
 def infer_parent_from_id(input_csv, output_csv):
     # Load the CSV file into a DataFrame
     df = pd.read_csv(input_csv)
 
     # Add a new column 'parent' based on the 'LABEL' column
-    def calculate_parent(label):
-        if isinstance(label, str):
-            if "." not in label:
-                return label
-            parent = label[:-1].rstrip(".")
-            # check if parent exists in the LABEL column
-            if parent not in df["LABEL"].values:
-                # If parent does not exist, return the original label
-                return label
-        return parent
-
-    df["parent"] = df["LABEL"].apply(calculate_parent)
+    df["parent"] = util.infer_parent_labels(df["LABEL"])
     # Reorder columns so 'parent' is the second column
     cols = list(df.columns)
     cols.insert(1, cols.pop(cols.index("parent")))
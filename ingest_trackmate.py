@@ -21,7 +21,8 @@ Convert TrackMate outputs into a format compatable for Loon software.
 Inputs: 
 - A CSV file from TrackMate
     - Must currently include 'LABEL', 'FRAME', 'POSITION_X', 'POSITION_Y' columns
-- A folder containing ROI files from TrackMate
+- A folder, or an ImageJ RoiSet.zip, containing ROI files from TrackMate
+- Optionally, the merged multi-page tif of the images
 
 Process:
 - Read the CSV file, remove unnecessary rows / columns, sort by frame
@@ -34,6 +35,8 @@ Outputs:
 - A metadata.csv file with metadata for Loon
 - A metadata.parquet file with metadata for Loon
 - A segmentations folder with geojson files for each frame
+- With the images, an images folder with an image_t{t}.ome.tiff per frame and images.companion.ome
+- With --dataset, a metadata_dataset folder with the metadata as a Parquet dataset partitioned by location
 
 """
 
@@ -42,10 +45,8 @@ import argparse
 import fnmatch
 from matlab_to_all import QUIET_MODE
 import util_common as util
-from roifile import ImagejRoi
-from geojson import Feature, Polygon, FeatureCollection, dumps
-from typing import Union, List
-import pandas as pd
+from itertools import groupby
+from typing import List
 import re
 
 
@@ -63,22 +64,20 @@ location = "location"
 # New track ID column
 loon_track = "loon_track"
 
-def main(csv_filename, roi_folder, output_folder):
+# Label columns stored as categoricals when compacting
+label_columns = [label, loon_track, "parent", inputLabel]
 
-    # load csv into df
-    df = pd.read_csv(csv_filename)
+# Types of the columns the conversion relies on, the others are inferred
+column_dtypes = {inputLabel: str, frame: "int64", position_x: "float64", position_y: "float64"}
 
-    # delete extra rows with metadata
-    df = df.drop([0, 1, 2])
-    # df = df.infer_objects() # this made everything an object, but I would've expected this to work
+def main(csv_filename, roi_folder, output_folder, workers=1, incremental=False, precision=util.DEFAULT_PRECISION, packed=False, image_filename=None, pyramid=False, dataset=False, frame_bucket_size=0, compact=False, tolerance=0.0):
+
+    # load csv into df, skipping the extra rows with metadata.
+    # MANUAL_SPOT_COLOR is all empty and is causing problems, so it is never loaded.
+    df = util.read_trackmate_csv(csv_filename, column_dtypes, ["MANUAL_SPOT_COLOR"])
 
     print(df.head())
     print(df.dtypes)
-    # reload and clean up temporary file.
-    temp_csv = os.path.join(output_folder, "temp.csv")
-    df.to_csv(temp_csv, index=False)
-    df = pd.read_csv(temp_csv)
-    os.remove(temp_csv)  # Clean up the temporary file
 
     # sort by frame
     # convert frame to int
@@ -86,7 +85,7 @@ def main(csv_filename, roi_folder, output_folder):
     df = df.sort_values(by=[frame])
 
 
-    df = df.rename(columns={"LOC": location})
+    df.rename(columns={"LOC": location}, inplace=True)
 
     # check if the required columns are present
     required_columns = [frame, position_x, position_y]
@@ -110,12 +109,8 @@ def main(csv_filename, roi_folder, output_folder):
     df[position_x] = df[position_x] * scaling_factor
     df[position_y] = df[position_y] * scaling_factor
 
-    # remove MANUAL_SPOT_COLOR column since it is all empty and is causing problems.
-    if "MANUAL_SPOT_COLOR" in df.columns:
-        df = df.drop(columns=["MANUAL_SPOT_COLOR"])
-
     # create new column for the track ID by dropping the spot ID from the label column
-    df[loon_track] = df[label].apply(lambda x: os.path.splitext(x)[0])
+    df[loon_track] = util.strip_extension(df[label])
 
     # move new column to first position
     cols = list(df.columns)
@@ -127,39 +122,32 @@ def main(csv_filename, roi_folder, output_folder):
     df = infer_parent_from_id(df, output_csv_filename)
 
     geojson_output_folder = os.path.join(output_folder, "segmentations")
-    roi_to_geojson(df, roi_folder, geojson_output_folder)
+    roi_to_geojson(df, roi_folder, geojson_output_folder, workers, incremental, precision, packed)
+
+    # split the merged tif into <output_folder>/images/image_t{t}.ome.tiff and images/images.companion.ome,
+    # as bfconvert -option ometiff.companion does, a frame at a time
+    if image_filename is not None:
+        util.write_ome_tiff_set(util.read_tiff_frames(image_filename), os.path.join(output_folder, "images"), pyramid=pyramid)
 
-    # run bf tools script, either automatically or manually.
-    # given an input merged tif with <input_image_path>
-    # ./bftools/bfconvert -option ometiff.companion <output_folder>/images/images.companion.ome <input_image_path> <output_folder>/images/image_t%t.ome.tiff
-    # e.g. if <input_image_path> is ./in/TRACKMATE_2/Merged.tif and <output_folder> is ./out/TRACKMATE_2
-    # then the command would be:
-    # ./bftools/bfconvert -option ometiff.companion ./out/TRACKMATE_2/images/images.companion.ome ./in/TRACKMATE_2/Merged.tif ./out/TRACKMATE_2/images/image_t%t.ome.tiff
+    # labels repeated on every row of a track are stored once per value, numbers in the smallest types that hold them
+    if compact:
+        df = util.compact_table(df, label_columns, tolerance)
 
     # create parquet file from the csv
     df.to_parquet(os.path.join(output_folder, "metadata.parquet"), index=False)
+    if dataset:
+        util.write_partitioned_dataset(df, os.path.join(output_folder, "metadata_dataset"), location, frame, frame_bucket_size)
 
     return
 
 # Given a dataframe with a track label column, create a parent column by infering parent values from labels.
 def infer_parent_from_id(df, output_csv):
     # Add a new column 'parent' based on the 'LABEL' column
-    def calculate_parent(child_label):
-        if isinstance(child_label, str):
-            if "." not in child_label:
-                return child_label
-            parent = child_label[:-1].rstrip(".")
-            # check if parent exists in the LABEL column
-            if parent not in df[label].values:
-                # If parent does not exist, return the original label
-                return child_label
-        return parent
-
-    df["parent"] = df[label].apply(calculate_parent)
-    # Reorder columns so 'parent' is the second column
-    cols = list(df.columns)
-    cols.insert(1, cols.pop(cols.index("parent")))
-    df = df[cols]
+    # as the second column
+    parent = util.infer_parent_labels(df[label])
+    if "parent" in df.columns:
+        df.drop(columns=["parent"], inplace=True)
+    df.insert(1, "parent", parent)
 
     util.ensure_directory_exists(output_csv)
     # Save the updated DataFrame to a new CSV file
@@ -169,36 +157,45 @@ def infer_parent_from_id(df, output_csv):
 
 ######################
 
-# Given a folder of ROI files and a dataframe, outputs a folder of GeoJson files
-def roi_to_geojson(df, roi_folder, output_folder):
+# Given a folder (or RoiSet.zip) of ROI files and a dataframe, outputs a folder of GeoJson files
+def roi_to_geojson(df, roi_folder, output_folder, workers=1, incremental=False, precision=util.DEFAULT_PRECISION, packed=False):
     # Checks for empty
     util.ensure_directory_exists(output_folder)
     util.msg_header("Finding ROI files", QUIET_MODE)
 
+    # ROI files are read from an ImageJ RoiSet.zip, or from a folder
+    archive = roi_folder if util.is_roi_archive(roi_folder) else None
+
     pattern = "Track_*.roi"
     filename_list = []
     found_count = 0
     print_every = 10
-    # Recursively searches for roi files matching 'pattern'
-    for root, _, files in os.walk(roi_folder):
-        path = root.replace(roi_folder, "", 1)
-        for name in fnmatch.filter(files, pattern):
-            filename_list.append((path, name))
-            found_count += 1
-            if found_count % print_every == 0:
-                util.msg(
-                    "{} Found: {} files.".format(
-                        util.textSpinner(found_count, 10_000), found_count
-                    ),
-                    QUIET_MODE,
-                    True,
-                )
-
-    # Sort the ROI filenames by folder, frame number, and track ID.
-    filename_list.sort(key=lambda f: (f[0], parse_frame(f[1], df), parse_id(f[1])))
+    if archive is not None:
+        # All members are listed from the archive's central directory
+        filename_list = util.list_roi_archive(archive, pattern)
+        found_count = len(filename_list)
+    else:
+        # Recursively searches for roi files matching 'pattern'
+        for root, _, files in os.walk(roi_folder):
+            path = os.path.relpath(root, roi_folder)
+            path = "" if path == os.curdir else path
+            for name in fnmatch.filter(files, pattern):
+                filename_list.append((path, name))
+                found_count += 1
+                if found_count % print_every == 0:
+                    util.msg(
+                        "{} Found: {} files.".format(
+                            util.textSpinner(found_count, 10_000), found_count
+                        ),
+                        QUIET_MODE,
+                        True,
+                    )
+
+    # Resolve the frame of every ROI filename, sorted by folder, frame number, and track ID.
+    filename_list = parse_frames(filename_list, df)
 
     # Log the number of files found
-    filename_stats = get_filename_stats(filename_list, df)
+    filename_stats = get_filename_stats(filename_list)
     util.msg(
         "✅ Found: {} files in {} folders.".format(found_count, len(filename_stats)),
         QUIET_MODE,
@@ -206,17 +203,38 @@ def roi_to_geojson(df, roi_folder, output_folder):
     )
 
 
-    feature_list = []
-    last_frame = -1
     last_path = ""
     file_count = 0
     folder_count = 0
 
-    # For each ROI file ... 
-    for path, name in filename_list:
+    # Group the ROI files by folder and frame. Each frame is decoded and serialized as one unit of work,
+    # in a process pool when workers > 1, and written here in manifest order.
+    frame_groups = [
+        (path, frame, [(util.roi_file(roi_folder, path, name, archive), parse_id(name)) for _, _, name in group])
+        for (path, frame), group in groupby(filename_list, key=lambda f: (f[0], f[1]))
+    ]
+
+    # With incremental, frames whose ROI files are unchanged since the last run are not converted again.
+    manifest = None
+    if incremental:
+        manifest = util.ConversionManifest(
+            os.path.join(output_folder, util.MANIFEST_FILENAME), settings={"precision": precision, "packed": packed}
+        )
+    is_current = [
+        manifest is not None
+        and manifest.is_current(
+            os.path.join(path, "frames", str(frame)), *util.roi_inputs([f for f, _ in roi_files], archive)
+        )
+        for path, frame, roi_files in frame_groups
+    ]
+    results = util.ordered_map(
+        util.convert_roi_frame,
+        [(frame, roi_files, archive, precision) for (_, frame, roi_files), current in zip(frame_groups, is_current) if not current],
+        workers,
+    )
 
-        # 
-        frame = parse_frame(name, df)
+    # For each frame of ROI files ...
+    for (path, frame, roi_files), current in zip(frame_groups, is_current):
 
         # Check if we're in a new folder; if so, update folder count and print a header.
         if path != last_path:
@@ -230,8 +248,8 @@ def roi_to_geojson(df, roi_folder, output_folder):
                 QUIET_MODE,
             )
             file_count = 0
-        file_count += 1
-        
+        file_count += len(roi_files)
+
         # Update the loading message with current file and frame progress.
         util.updateLoadingMessage(
             file_count,
@@ -240,46 +258,32 @@ def roi_to_geojson(df, roi_folder, output_folder):
             False,
         )
 
-        # When a new frame is encountered, export the collected features for the previous frame.
-        if last_frame != frame and last_frame != -1:
-            export(
-                feature_list,
-                os.path.join(output_folder, last_path, "frames"),
-                str(last_frame),
-            )
-            feature_list = []
-
-        # Update the last processed frame and folder path trackers.
-        last_frame = frame
+        # Update the last processed folder path tracker.
         last_path = path
 
-        # Construct the full path to the ROI file and parse its cell ID.
-        filename = os.path.join(roi_folder, path, name)
-        cell_id = parse_id(name)
-        # Read the ROI file and convert its coordinates into a polygon feature.
-        roi = ImagejRoi.fromfile(filename)
-        outer_polygon_coords = roi.coordinates().tolist()
-        outer_polygon_coords.append(
-            outer_polygon_coords[0]
-        )  # add beginning to end to close loop
-        feature = Feature(
-            geometry=Polygon([outer_polygon_coords]),
-            properties={"id": cell_id, "frame": frame},
-            bbox=[roi.left, roi.bottom, roi.right, roi.top],
-        )
-        # Export the individual cell feature into the corresponding folder.
+        # Skip frames a previous run already converted.
+        if current:
+            continue
+        cell_jsons = next(results)
+
+        # Export the individual cell features into the corresponding folder,
+        # and stream the same json into the FeatureCollection of the whole frame.
         # Export in format frame-cell_id
         # Example: 26-73_Track_965.b.json
-        export(
-            feature,
-            os.path.join(output_folder, last_path, "cells"),
-            "{}-{}".format(str(frame), cell_id),
+        # When packed, the cells are only indexed by their byte range in the frame's collection.
+        output_paths = util.export_frame_cells(
+            os.path.join(output_folder, path),
+            frame,
+            [(cell_id, cell_json) for (_, cell_id), cell_json in zip(roi_files, cell_jsons)],
+            OVERWRITE,
+            packed,
         )
-        feature_list.append(feature)
-    # Export any remaining features for the last processed frame.
-    export(
-        feature_list, os.path.join(output_folder, last_path, "frames"), str(last_frame)
-    )
+        if manifest is not None:
+            input_paths, extra = util.roi_inputs([f for f, _ in roi_files], archive)
+            manifest.record(os.path.join(path, "frames", str(frame)), input_paths, output_paths, extra)
+
+    if manifest is not None:
+        manifest.save()
 
     # Finalize the output by returning carriage and printing the completion message.
     util.return_carriage(QUIET_MODE)
@@ -289,52 +293,23 @@ def roi_to_geojson(df, roi_folder, output_folder):
 
 
 # Returns the count and frames of filenames.
-def get_filename_stats(filename_list: List, df) -> dict:
+def get_filename_stats(filename_list: List) -> dict:
     filename_stats = {}
-    for path, name in filename_list:
-        frame = parse_frame(name, df)
+    for path, frame, name in filename_list:
         if path not in filename_stats:
             filename_stats[path] = {"count": 0, "frames": 0}
         filename_stats[path]["count"] += 1
         filename_stats[path]["frames"] = max(filename_stats[path]["frames"], frame)
     return filename_stats
 
-
-def feature_list_to_json(feature_list: List) -> str:
-    feature_collection = FeatureCollection(feature_list)
-    return dumps(feature_collection)
-
-
-def feature_to_json(feature: Feature) -> str:
-    return dumps(feature)
-
-# Export ROI data
-def export(data: Union[Feature, List], full_path: str, name: str):
-    # If data is a single feature, convert to JSON
-    if isinstance(data, Feature):
-        data = feature_to_json(data)
-    # Otherwise convert feature list to FeatureCollection JSON
-    else:
-        data = feature_list_to_json(data)
-    util.export_file(data, full_path, name, OVERWRITE)
-    return
-
-# Given a filename and df, extract unique frame number.
-def parse_frame(filename: str, df) -> int:
-    # Remove file extension from filename
-    name_base = os.path.splitext(filename)[0]
-    # Get the track ID and cell index from the name_base
-    if "-" not in name_base:
-        name_base = name_base + "-0" 
-    track_id, cell_index = name_base.split("-")
-
-    # Find the track based on track id, sort by frame
-    track = df.loc[df[inputLabel] == track_id]
-    track = track.sort_values(by=[frame])
-    # Find the nth (cell_index) frame for this track
-    track_frame = track.iloc[int(cell_index)][frame]
-    
-    return int(track_frame)
+# Given (path, filename) pairs and df, returns (path, frame, filename) sorted by folder, frame number, and track ID.
+def parse_frames(filename_list: List, df) -> List:
+    # Group the table by track once, then resolve every filename's frame in one pass
+    frame_index = util.TrackFrameIndex(df, inputLabel, frame)
+    frames = frame_index.resolve([name for _, name in filename_list])
+    manifest = [(path, int(f), name) for (path, name), f in zip(filename_list, frames)]
+    manifest.sort(key=lambda m: (m[0], m[1], parse_id(m[2])))
+    return manifest
 
 # Given a filename, returns the track_id
 def parse_id(filename: str) -> int:
@@ -357,10 +332,67 @@ if __name__ == "__main__":
         description="Infer parent from LABEL column in a CSV file."
     )
     parser.add_argument("input_csv", help="Path to the input CSV file")
-    parser.add_argument("roi_folder", help="Path to the input roi folder")
+    parser.add_argument("roi_folder", help="Path to the input roi folder or RoiSet.zip")
     parser.add_argument("output_folder", help="Path to the output folder")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes converting ROI files (default: 1)",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only convert the frames whose ROI files changed since the last run",
+    )
+    parser.add_argument(
+        "--precision",
+        type=int,
+        default=util.DEFAULT_PRECISION,
+        help="Decimals kept in segmentation coordinates, 0 writes integers (default: {})".format(util.DEFAULT_PRECISION),
+    )
+    parser.add_argument(
+        "--packed",
+        action="store_true",
+        help="Write the cells of each frame into one file with a byte range index, instead of one file per cell",
+    )
+
+    parser.add_argument(
+        "--image",
+        help="Path to the merged multi-page tif, written to the output folder as an OME-TIFF set with a companion file",
+    )
+
+    parser.add_argument(
+        "--pyramid",
+        action="store_true",
+        help="Write the images as tiled, compressed pages with reduced resolutions",
+    )
+
+    parser.add_argument(
+        "--dataset",
+        action="store_true",
+        help="Also write the metadata as a Parquet dataset partitioned by location, with statistics and page indexes",
+    )
+    parser.add_argument(
+        "--frame-bucket",
+        type=int,
+        default=0,
+        help="With --dataset, also partition each location by buckets of this many frames (default: 0, no buckets)",
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="Store label columns as categoricals and numbers in smaller types in the metadata Parquet",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.0,
+        help="With --compact, largest change allowed when storing a float column as float32 (default: 0, exact)",
+    )
 
     # Parse the arguments
     args = parser.parse_args()
 
-    main(args.input_csv, args.roi_folder, args.output_folder)
+    main(args.input_csv, args.roi_folder, args.output_folder, args.workers, args.incremental, args.precision, args.packed, args.image, args.pyramid,
+         args.dataset, args.frame_bucket, args.compact, args.tolerance)
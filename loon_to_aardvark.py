@@ -2,17 +2,18 @@
 Converts a single Loon experiment to an Aardvark experiment.
 '''
 import os
+import glob
 import json
+import mmap
+from itertools import chain, islice
 # from google.protobuf import descriptor_pb2
 # import google.protobuf.text_format as text_format
 import protoDefs.PbCurveList_pb2 as pbCurveList
 import protoDefs.RLE_pb2 as rle
 import pandas as pd
 import numpy as np
+import pyarrow as pa
 from PIL import Image
-import tifffile as tf
-from imantics import Mask
-from geojson import Feature, Polygon, dumps
 import util_common as util
 
 
@@ -21,42 +22,30 @@ IN_FOLDER = './in/'
 OUT_FOLDER_ROOT = './out/'
 EXPERIMENT_NAME = 'MCF7DrugResponsePanelA_cellgrowthutiltes'
 LOON_FOLDER = '.vizMetaData/'
+INCREMENTAL = False # only convert the locations whose images or segmentations changed since the last run
+PACKED = False # index the cells inside frames/{frame}.json instead of writing one file per cell
+CURVES_PER_BATCH = 10_000 # tracks decoded at a time from massOverTime.pb
+WORKERS = 1 # processes converting locations in parallel
+PYRAMID = False # write tiled, compressed frames with reduced resolutions, for viewers to read only what they show
+PARTITIONED = False # also write the table as a Parquet dataset partitioned by location, for reading one location at a time
+FRAME_BUCKET_SIZE = 0 # with PARTITIONED, also partition each location by buckets of this many frames
+COMPACT = False # store the table's columns in the smallest types that hold them, see util.compact_table
+COMPACT_TOLERANCE = 0.0 # largest change allowed when storing float64 columns as float32
 
 def main():
     OUT_FOLDER = os.path.join(OUT_FOLDER_ROOT, EXPERIMENT_NAME)
     os.makedirs(OUT_FOLDER, exist_ok=True)
+    manifest = None
+    if INCREMENTAL:
+        manifest = util.ConversionManifest(os.path.join(OUT_FOLDER, util.MANIFEST_FILENAME), settings={'packed': PACKED})
 
     # Load the protobuf metadata file
     mass_over_time_filename = os.path.join(IN_FOLDER, EXPERIMENT_NAME, LOON_FOLDER, 'massOverTime.pb')
 
-    column_dictionary = {} # will be used to map column names to their respective column values
-
     util.msg_header('Converting Tabular Data', False)
-    curve_list = pbCurveList.PbCurveList()
-    with open(mass_over_time_filename, 'rb') as f:
-        curve_list.ParseFromString(f.read())
-        # initialize the columns
-        column_dictionary['track_id'] = []
-
-        cell_attr_index_to_name = {}
-        for i, cell_level_attr in enumerate(curve_list.pointAttrNames):
-            column_dictionary[cell_level_attr] = []
-            cell_attr_index_to_name[i] = cell_level_attr
-
-        track_attr_index_to_name = {}
-        for i, track_level_attr in enumerate(curve_list.curveAttrNames):
-            column_dictionary[track_level_attr] = []
-            track_attr_index_to_name[i] = track_level_attr
-    
-        for curve in curve_list.curveList:
-            for point in curve.pointList:
-                column_dictionary['track_id'].append(curve.id)
-                for i, attr in enumerate(curve.valueList):
-                    column_dictionary[track_attr_index_to_name[i]].append(attr)
-                for i, attr in enumerate(point.valueList):
-                    column_dictionary[cell_attr_index_to_name[i]].append(attr)
-
-    df = pd.DataFrame(column_dictionary)
+    # the tracks are decoded in batches of columns, one row per point
+    with CurveListReader(mass_over_time_filename) as curve_list:
+        df = pa.Table.from_batches(curve_list.iter_batches(CURVES_PER_BATCH), curve_list.schema).to_pandas()
 
     # rename column names to match expected aardvark names
     df.rename(columns={
@@ -72,17 +61,14 @@ def main():
     df['y'] = (df['Y_original'] + df['yShift']) / 4.0
 
     # print(df.head())
+    if COMPACT:
+        # the Loon attributes are all numbers, ids and locations become small integers
+        df = util.compact_table(df, tolerance=COMPACT_TOLERANCE)
 
     # Save the full dataframe to a parquet file
     df.to_parquet(os.path.join(OUT_FOLDER, 'composite_tabular_data_file.parquet'))
-
-    # group by the "location" and save each grouped dataframe to a csv file
-    for name, group in df.groupby('location'):
-        location_id = str(int(name))
-        # create a folder for each location id
-        location_folder = os.path.join(OUT_FOLDER, "loc_" + location_id)
-        os.makedirs(location_folder, exist_ok=True)
-        group.to_csv(os.path.join(location_folder, 'metadata.csv'), index=False)
+    if PARTITIONED:
+        util.write_partitioned_dataset(df, os.path.join(OUT_FOLDER, 'composite_tabular_data'), 'location', 'Frame ID', FRAME_BUCKET_SIZE)
 
     # get list of unique location IDs for convenience
     location_ids = df['location'].unique()
@@ -91,87 +77,51 @@ def main():
     # get frame count
     frame_count = df['Frame ID'].max()
 
-    # convert images
-    util.msg_header('Converting Images', False)
-
     image_metadata_filename = os.path.join(IN_FOLDER, EXPERIMENT_NAME, LOON_FOLDER, 'imageMetaData.json')
     image_metadata = json.load(open(image_metadata_filename))
     tile_width = image_metadata['tileWidth']
     tile_height = image_metadata['tileHeight']
     number_of_columns = image_metadata['numberOfColumns']
-
-    for location in location_ids:
-        util.msg('Location: ' + location + ' / ' + str(len(location_ids)), False, True)
-
-        # TODO: This would have to be updated if the Loon data has more than one chunk per location.
-        image_filename = os.path.join(IN_FOLDER, EXPERIMENT_NAME, 'data' + location, 'D0.jpg')
-        # load image into np array
-        image = Image.open(image_filename)
-        image_np = np.array(image)
-        # print(image_np.shape)
-        number_of_rows = image_np.shape[0] // tile_height
-
-        # convert to ome tiff file
-        frame = 1
-        tiff_filename = os.path.join(OUT_FOLDER, 'loc_' + location, 'image_stack.tif')
-        with tf.TiffWriter(tiff_filename) as tif:
-            for i in range(number_of_rows):
-                for j in range(number_of_columns):
-                    tile = image_np[i*tile_height:(i+1)*tile_height, j*tile_width:(j+1)*tile_width, 0]
-                    tif.write(tile)
-                    frame += 1
-                    if frame > frame_count:
-                        break
-    util.msg('Images converted.', False)
-
-
-    # convert segmentations
-    util.msg_header('Converting Segmentations', False)
-    for location in location_ids:
-        util.msg('Location: ' + location + ' / ' + str(len(location_ids)), False, True)
-        segmentation_folder = os.path.join(OUT_FOLDER, 'loc_' + location, 'segmentations')
-        os.makedirs(segmentation_folder, exist_ok=True)
-        cell_segmentations_folder = os.path.join(OUT_FOLDER, 'loc_' + location, 'segmentations', 'cells')
-        os.makedirs(cell_segmentations_folder, exist_ok=True)
-        rle_filename = os.path.join(IN_FOLDER, EXPERIMENT_NAME, 'data' + location, 'L0.pb')
-        imageLabels = rle.ImageLabels()
-
-        # build lookup dictionary from frame and segment id to cell id
-        cell_id_dict = {}
-        location_df = df[df['location'] == int(location)]
-        for index, row in location_df.iterrows():
-            key = str(int(row['Frame ID'])) + '-' + str(int(row['segmentLabel']))
-            cell_id_dict[key] = int(row['track_id'])
-
-        with open(rle_filename, 'rb') as f:
-            imageLabels.ParseFromString(f.read())
-            frame_number = 0
-            for i, row in enumerate(imageLabels.rowList):
-                j = i % tile_height
-                if j == 0:
-                    # reset mask
-                    mask = np.zeros((tile_height, tile_width), dtype=np.uint32)
-                    segment_labels = set()
-                    frame_number += 1
-                for run in row.row:
-                    mask[j, run.start:run.start+run.length] = run.label
-                    segment_labels.add(run.label)
-                if j == tile_height - 1:
-                    for segment_label in segment_labels:
-                        segment_mask = mask == segment_label
-                        segment_mask = Mask(segment_mask)
-                        polygons = segment_mask.polygons()
-                        bbox = segment_mask.bbox()
-                        bbox_values = [bbox.min_point[0], bbox.max_point[1], bbox.max_point[0], bbox.min_point[1]]
-                        key = str(int(frame_number)) + '-' + str(int(segment_label))
-                        cell_id = cell_id_dict.get(key, -404) # TODO: make dict
-
-                        for polygon_verts in polygons.points:
-                            outer_polygon_coords = polygon_verts.tolist()
-                            outer_polygon_coords.append(outer_polygon_coords[0]) # add beginning to end to close loop
-                            feature = Feature(geometry=Polygon([outer_polygon_coords]), properties={"id": cell_id,'frame': frame_number}, bbox=bbox_values)
-                            util.export_file(dumps(feature), cell_segmentations_folder, '{}-{}'.format(str(frame_number), cell_id), True)
-    util.msg('Segmentations converted.', False)
+    # the tiles also depend on the tiling metadata
+    image_extra = '{}x{}, {} columns, {} frames'.format(tile_width, tile_height, number_of_columns, frame_count)
+    if PYRAMID:
+        image_extra += ', pyramid'
+
+    # each location's table, image stack and segmentations are converted by one worker
+    util.msg_header('Converting Locations', False)
+    location_rows = df.groupby('location').indices
+    location_inputs = {}
+
+    def location_tasks():
+        for location in location_ids:
+            location_df = df.iloc[location_rows[int(location)]]
+            image_filenames = mosaic_chunk_filenames(os.path.join(IN_FOLDER, EXPERIMENT_NAME, 'data' + location))
+            companion_filename = os.path.join(OUT_FOLDER, 'loc_' + location, 'images', util.OME_COMPANION_FILENAME)
+            rle_filename = os.path.join(IN_FOLDER, EXPERIMENT_NAME, 'data' + location, 'L0.pb')
+            segmentation_folder = os.path.join(OUT_FOLDER, 'loc_' + location, 'segmentations')
+            convert_image = convert_segmentations = True
+            segmentation_extra = None
+            if manifest is not None:
+                # the segmentations also depend on the location's mapping from frame and segment id to cell id
+                segmentation_extra = util.array_digest(location_df['Frame ID'].to_numpy(), location_df['segmentLabel'].to_numpy(), location_df['track_id'].to_numpy())
+                convert_image = not manifest.is_current(companion_filename, image_filenames, image_extra)
+                convert_segmentations = not manifest.is_current(segmentation_folder, [rle_filename], segmentation_extra)
+            location_inputs[location] = (image_filenames, companion_filename, rle_filename, segmentation_folder, segmentation_extra)
+            yield (location, location_df, OUT_FOLDER, image_filenames if convert_image else None, rle_filename if convert_segmentations else None,
+                   (tile_width, tile_height, number_of_columns), frame_count, PACKED, PYRAMID)
+
+    # (location, frame, segment label) to cell id, built once over all locations and handed to each worker
+    cell_id_index = util.SegmentCellIndex(df, 'Frame ID', 'segmentLabel', 'track_id', 'location')
+    results = util.ordered_map(convert_location, location_tasks(), WORKERS, set_cell_ids, (cell_id_index,))
+    for location_count, (location, image_paths, segmentation_paths) in enumerate(results, start=1):
+        image_filenames, companion_filename, rle_filename, segmentation_folder, segmentation_extra = location_inputs.pop(location)
+        if manifest is not None:
+            if image_paths is not None:
+                manifest.record(companion_filename, image_filenames, image_paths, image_extra)
+            if segmentation_paths is not None:
+                manifest.record(segmentation_folder, [rle_filename], segmentation_paths, segmentation_extra)
+        util.updateLoadingMessage(location_count, len(location_ids), 'locations. Location {} converted'.format(location), False)
+    util.msg('Locations converted.', False)
 
     # convert experiment metadata
     experiment_metadata_filename = os.path.join(IN_FOLDER, EXPERIMENT_NAME, LOON_FOLDER, 'experimentMetaData.json')
@@ -211,9 +161,221 @@ def main():
 
     # Save the Aardvark metadata to a json file
     json.dump(aardvark_metadata, open(os.path.join(OUT_FOLDER_ROOT, f'{EXPERIMENT_NAME}.json'), 'w'))
+    if manifest is not None:
+        manifest.save()
 
     return
 
 
+_cell_id_index = None # (location, frame, segment label) to cell id, set in each process converting locations
+
+def set_cell_ids(cell_id_index: util.SegmentCellIndex):
+    global _cell_id_index
+    _cell_id_index = cell_id_index
+
+def convert_location(location: str, location_df: pd.DataFrame, out_folder: str, image_filenames: list, rle_filename: str,
+                     tiling: tuple, frame_count: int, packed: bool, pyramid: bool = False) -> tuple:
+    # Writes a location's table, and its images and segmentations unless their input is None.
+    # Returns the location and the paths written for the images and for the segmentations (None when skipped).
+    tile_width, tile_height, number_of_columns = tiling
+    location_folder = os.path.join(out_folder, 'loc_' + location)
+    os.makedirs(location_folder, exist_ok=True)
+    location_df.to_csv(os.path.join(location_folder, 'metadata.csv'), index=False)
+
+    image_paths = None
+    if image_filenames is not None:
+        # each tile is a frame of the OME-TIFF set read through images/images.companion.ome
+        tiles = islice(iter_mosaic_tiles(image_filenames, tile_width, tile_height, number_of_columns), int(frame_count))
+        image_paths = util.write_ome_tiff_set(tiles, os.path.join(location_folder, 'images'), pyramid=pyramid)
+
+    segmentation_paths = None
+    if rle_filename is not None:
+        segmentation_folder = os.path.join(location_folder, 'segmentations')
+        os.makedirs(os.path.join(segmentation_folder, 'cells'), exist_ok=True)
+        segmentation_paths = []
+        # the label file is read a tile (frame) at a time
+        for frame_number, runs in enumerate(iter_label_frames(rle_filename, tile_height), start=1):
+            frame_cells = []
+            # segments are traced straight from the runs of the tile, without rasterizing the whole tile
+            traced = list(util.run_polygons(*runs))
+            cell_ids = _cell_id_index.lookup(frame_number, [label for label, _, _, _ in traced], int(location)).tolist()
+            for cell_id, (_, polygons, (xmin, ymin, xmax, ymax), _) in zip(cell_ids, traced):
+                bbox_values = [xmin, ymax, xmax, ymin]
+                for rings in polygons:
+                    frame_cells.append((cell_id, util.encode_feature(rings, {"id": cell_id,'frame': frame_number}, bbox_values)))
+            segmentation_paths += util.export_frame_cells(segmentation_folder, frame_number, frame_cells, True, packed, frame_collection=False)
+    return location, image_paths, segmentation_paths
+
+def mosaic_chunk_filenames(data_folder: str) -> list:
+    # the D0.jpg, D1.jpg, ... mosaic chunks of a location, in chunk order
+    filenames = [f for f in glob.glob(os.path.join(data_folder, 'D*.jpg')) if os.path.basename(f)[1:-4].isdigit()]
+    return sorted(filenames, key=lambda f: int(os.path.basename(f)[1:-4]))
+
+def iter_mosaic_tiles(image_filenames: list, tile_width: int, tile_height: int, number_of_columns: int):
+    # Tiles of a location's mosaic chunks, row by row and chunk by chunk, from the first channel.
+    # Each chunk is decoded whole: Pillow's libjpeg decoder has no row or crop decoding, and the red channel
+    # needs all three components, so peak memory is one fully decoded RGB chunk. Only its first channel is
+    # kept while the tiles are cut, and the chunks are read one after another, never all at once.
+    for image_filename in image_filenames:
+        with Image.open(image_filename) as image:
+            channel = np.asarray(image.getchannel(0))
+        for top in range(0, channel.shape[0] - tile_height + 1, tile_height):
+            for j in range(number_of_columns):
+                yield channel[top:top + tile_height, j*tile_width:(j+1)*tile_width]
+
+def read_varint(buffer, position: int) -> tuple:
+    # protobuf base 128 varint at position, and the position after it
+    result = shift = 0
+    while True:
+        byte = buffer[position]
+        position += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, position
+        shift += 7
+
+def read_stream_varint(stream):
+    # protobuf base 128 varint read from a file, None at the end of the file
+    result = shift = 0
+    while True:
+        byte = stream.read(1)
+        if not byte:
+            if shift == 0:
+                return None
+            raise ValueError('Truncated protobuf varint in {}'.format(stream.name))
+        result |= (byte[0] & 0x7f) << shift
+        if byte[0] < 0x80:
+            return result
+        shift += 7
+
+def message_fields(buffer, start: int = 0, stop: int = None):
+    # (field number, field start, value start, value stop) of each field of a serialized protobuf message
+    position = start
+    stop = len(buffer) if stop is None else stop
+    while position < stop:
+        field_start = position
+        key, position = read_varint(buffer, position)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            _, value_stop = read_varint(buffer, position)
+        elif wire_type == 1:
+            value_stop = position + 8
+        elif wire_type == 2:
+            length, position = read_varint(buffer, position)
+            value_stop = position + length
+        elif wire_type == 5:
+            value_stop = position + 4
+        else:
+            raise ValueError('Unsupported protobuf wire type {} in field {}'.format(wire_type, number))
+        yield number, field_start, position, value_stop
+        position = value_stop
+
+class CurveListReader:
+    '''
+    Columnar reader of a Loon massOverTime.pb. The file is memory mapped and only its field boundaries are scanned
+    up front, then the tracks are parsed a batch at a time into one numpy column per attribute, with a row per point.
+    '''
+    CURVE_FIELD = 5
+    POINT_ATTR_NAMES_FIELD = 6
+    CURVE_ATTR_NAMES_FIELD = 7
+
+    def __init__(self, filename: str):
+        self.file = open(filename, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size > 0 else b''
+        self.point_attr_names, self.curve_attr_names = [], []
+        self.curve_ranges = [] # (field start, value stop) of each curve
+        for number, field_start, value_start, value_stop in message_fields(self.buffer):
+            if number == self.CURVE_FIELD:
+                self.curve_ranges.append((field_start, value_stop))
+            elif number == self.POINT_ATTR_NAMES_FIELD:
+                self.point_attr_names.append(bytes(self.buffer[value_start:value_stop]).decode('utf-8'))
+            elif number == self.CURVE_ATTR_NAMES_FIELD:
+                self.curve_attr_names.append(bytes(self.buffer[value_start:value_stop]).decode('utf-8'))
+        self.schema = pa.schema([('track_id', pa.int64())] + [(name, pa.float64()) for name in self.point_attr_names + self.curve_attr_names])
+
+    def iter_batches(self, curves_per_batch: int = 10_000):
+        for i in range(0, len(self.curve_ranges), curves_per_batch):
+            batch_ranges = self.curve_ranges[i:i + curves_per_batch]
+            # consecutive curves are parsed together, as the curve list they are a slice of
+            batch = pbCurveList.PbCurveList()
+            for start, stop in _contiguous_ranges(batch_ranges):
+                batch.MergeFromString(self.buffer[start:stop])
+            yield self.curves_to_batch(batch.curveList)
+
+    def curves_to_batch(self, curves) -> pa.RecordBatch:
+        point_counts = np.fromiter((len(curve.pointList) for curve in curves), dtype=np.int64, count=len(curves))
+        point_count = int(point_counts.sum())
+        ids = np.fromiter((curve.id for curve in curves), dtype=np.int64, count=len(curves))
+        curve_values = np.fromiter(chain.from_iterable(curve.valueList for curve in curves), dtype=np.float32)
+        point_values = np.fromiter(chain.from_iterable(point.valueList for curve in curves for point in curve.pointList), dtype=np.float32)
+        if curve_values.size != len(curves) * len(self.curve_attr_names) or point_values.size != point_count * len(self.point_attr_names):
+            raise ValueError('Every track and point of {} needs one value per attribute name'.format(self.file.name))
+        # track level values are repeated over the track's points
+        curve_values = np.repeat(curve_values.reshape(len(curves), len(self.curve_attr_names)), point_counts, axis=0)
+        point_values = point_values.reshape(point_count, len(self.point_attr_names))
+        columns = [np.repeat(ids, point_counts)]
+        columns += [point_values[:, i].astype(np.float64) for i in range(len(self.point_attr_names))]
+        columns += [curve_values[:, i].astype(np.float64) for i in range(len(self.curve_attr_names))]
+        return pa.RecordBatch.from_arrays([pa.array(column) for column in columns], schema=self.schema)
+
+    def close(self):
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+LABEL_ROW_FIELD = 1 # ImageLabels.rowList
+
+def iter_label_frames(filename: str, tile_height: int):
+    # Runs (row in the frame, start column, length, label) of each frame of a Loon L0.pb, whose rows are
+    # tile_height rows per frame. The rows are read from the file as they come, so only one frame is held
+    # in memory and the first frame is yielded before the rest of the file is read. Trailing rows of an
+    # incomplete frame are ignored.
+    with open(filename, 'rb') as f:
+        frame_rows = []
+        while True:
+            key = read_stream_varint(f)
+            if key is None:
+                break
+            number, wire_type = key >> 3, key & 7
+            if wire_type != 2:
+                raise ValueError('Unexpected protobuf wire type {} in field {} of {}'.format(wire_type, number, filename))
+            length = read_stream_varint(f)
+            value = f.read(length) if length is not None else b''
+            if length is None or len(value) != length:
+                raise ValueError('Truncated label row in {}'.format(filename))
+            if number != LABEL_ROW_FIELD:
+                continue
+            frame_rows.append(rle.Row.FromString(value))
+            if len(frame_rows) == tile_height:
+                yield _row_runs(frame_rows)
+                frame_rows = []
+
+def _row_runs(rows) -> tuple:
+    run_counts = np.fromiter((len(row.row) for row in rows), dtype=np.int64, count=len(rows))
+    run_count = int(run_counts.sum())
+    run_rows = np.repeat(np.arange(len(rows), dtype=np.int64), run_counts)
+    starts = np.fromiter((run.start for row in rows for run in row.row), dtype=np.int64, count=run_count)
+    lengths = np.fromiter((run.length for row in rows for run in row.row), dtype=np.int64, count=run_count)
+    labels = np.fromiter((run.label for row in rows for run in row.row), dtype=np.int64, count=run_count)
+    return run_rows, starts, lengths, labels
+
+def _contiguous_ranges(ranges):
+    # merges (start, stop) ranges that follow each other
+    merged = []
+    for start, stop in ranges:
+        if merged and merged[-1][1] == start:
+            merged[-1][1] = stop
+        else:
+            merged.append([start, stop])
+    return merged
+
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
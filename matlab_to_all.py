@@ -1,71 +1,67 @@
+from functools import partial
 from math import nan
-from typing import Dict
 import numpy as np
 import pandas as pd
 import tifffile as tf
-from imantics import Mask
-from geojson import Feature, Polygon, dumps
 import util_common as util
 import os
 
 IN_FOLDER = './in/'
 OUT_FOLDER = './out/'
 QUIET_MODE = False
+INCREMENTAL = False # only convert the image stack and frames that changed since the last run
+PACKED = False # index the cells inside frames/{frame}.json instead of writing one file per cell
+WORKERS = 1 # processes tracing segmentation frames
+OME_COMPANION = True # write the images as ome/image_t{t}.ome.tiff files and ome/images.companion.ome instead of one multi-page tif
+PYRAMID = False # write tiled, compressed frames with reduced resolutions, for viewers to read only what they show
+COMPACT = False # store the table's columns in the smallest types that hold them, see util.compact_table
+COMPACT_TOLERANCE = 0.0 # largest change allowed when storing float64 columns as float32
 
 def main():
-    cell_id_dict = matlab_to_csv('Loc_4_well_23/cells.mat')
-    matlab_to_tiff_and_json('Loc_4_well_23/images.mat', cell_id_dict)
+    manifest = None
+    if INCREMENTAL:
+        manifest = util.ConversionManifest(os.path.join(OUT_FOLDER, util.MANIFEST_FILENAME), settings={'packed': PACKED})
+    cell_id_index = matlab_to_csv('Loc_4_well_23/cells.mat')
+    matlab_to_tiff_and_json('Loc_4_well_23/images.mat', cell_id_index, manifest)
+    if manifest is not None:
+        manifest.save()
     return
 
-def matlab_to_csv(filename: str) -> Dict:
+def matlab_to_csv(filename: str) -> util.SegmentCellIndex:
     util.msg_header('Extracting csv from ' + filename, QUIET_MODE)
 
     matlab_data = util.openAnyMatlabFile(IN_FOLDER + filename)
-    cell_data_list = util.getNormalizedMatlabObjectFromKey(matlab_data, 'Cells_Struct')[0]
    
     attribute_keys = ['mass', 'MI', 'A', 'ii_stored', 'x', 'y']
     # segID - number used in mask, need to keep track of for the mask to polygon conversion later
-    cell_id_dict = {}
     time_key = 'time'
     keys = [time_key]
     keys.extend(attribute_keys)
 
     id = 'CellID' #'CellNum'
     parent = 'ParentCell'
-    data_arrays = []
-    # edges = []
     noParent = -404
-    cell_number = 1
-    for cell in cell_data_list:
-        util.updateLoadingMessage(cell_number, len(cell_data_list), 'cells', QUIET_MODE)
-        cell_number += 1
-        cell_id = cell[id][0][0]
-        for i in range(len(cell['segID'])):
-            segID = cell['segID'][i][0]
-            frame = cell['ii_stored'][i][0]
-            cell_id_dict[str(frame) + '-' + str(segID)] = int(cell_id)
-        # parent_id = cell[parent]
-        # if len(parent_id) > 0:
-        #     parent_id = parent_id[0][0]
-        #     if cell['FounderMark'][0][0] == 1:
-        #         parent_id = noParent
-        # else:
-        #     parent_id = noParent
-        # edges.append([cell_id, parent_id])
-
-        data_length = len(cell[time_key])
-        id_col = np.full((data_length, 1), cell[id], dtype='uint')
-        parent_col = np.full((data_length, 1), cell[parent], dtype='uint')
-        values = [id_col, parent_col]
-        for key in keys:
-            values.append(cell[key])
-        combined = np.array(values).T[0]
-        data_arrays.append(combined)
-    util.return_carriage(QUIET_MODE)
-    data_out = np.concatenate(data_arrays, axis=0)
-    column_names = ['id', 'parent']
-    column_names.extend(keys)
-    df = pd.DataFrame(data_out, columns=column_names)
+    # the fields of every cell are read once and joined column by column
+    fields = util.getMatlabStructFields(matlab_data, 'Cells_Struct', [id, parent, 'segID'] + keys)
+    util.msg('{} cells.'.format(len(fields[id])), QUIET_MODE)
+    row_counts = np.array([len(values) for values in fields[time_key]], dtype=np.int64)
+    row_count = int(row_counts.sum())
+
+    columns = {}
+    # a cell's id and parent are repeated on each of its rows, a missing parent is 0
+    cell_ids = np.array([np.ravel(values)[0] for values in fields[id]])
+    parent_ids = np.array([np.ravel(values)[0] if np.size(values) > 0 else 0 for values in fields[parent]]).astype('uint')
+    columns['id'] = np.repeat(cell_ids.astype('uint'), row_counts).astype(np.float64)
+    columns['parent'] = np.repeat(parent_ids, row_counts).astype(np.float64)
+    for key in keys + ['segID']:
+        columns[key] = np.empty(row_count, dtype=np.float64)
+        np.concatenate([np.ravel(values) for values in fields[key]] or [np.empty(0)], out=columns[key])
+
+    # (frame, segID) to cell id, -404 where no cell has that segment
+    cell_id_index = util.SegmentCellIndex(pd.DataFrame({'frame': columns['ii_stored'], 'segID': columns['segID'], 'id': np.repeat(cell_ids, row_counts)}),
+                                          'frame', 'segID', 'id', missing=noParent)
+
+    df = pd.DataFrame({key: columns[key] for key in ['id', 'parent'] + keys})
     df['id'] = df['id'].astype(int)
     df['parent'] = df['parent'].astype(int)
     df['parent'] = df['parent'].replace(0, -404)
@@ -73,6 +69,8 @@ def matlab_to_csv(filename: str) -> Dict:
     df = df.sort_values('time')
     df.rename(columns={'ii_stored': 'frame'}, inplace=True)
     # df['frame'] = df['frame'].astype(int) - 1
+    if COMPACT:
+        df = util.compact_table(df, tolerance=COMPACT_TOLERANCE)
     out_path = OUT_FOLDER + filename
     out_path = out_path.removesuffix('.mat') + '.csv'
     util.ensure_directory_exists(out_path)
@@ -84,20 +82,56 @@ def matlab_to_csv(filename: str) -> Dict:
     # df['parent'] = df['parent'].replace(noParent, '')
     # print(df)
     # df.to_csv(OUT_FOLDER + 'edges.csv', index=False, header=True)
-    return cell_id_dict
+    return cell_id_index
+
+_cell_id_index = None # (frame, segID) to cell id, set in each process exporting segmentation frames
+
+def set_cell_ids(cell_id_index: util.SegmentCellIndex):
+    global _cell_id_index
+    _cell_id_index = cell_id_index
 
-def matlab_to_tiff_and_json(filename: str, cell_id_dict: Dict):
+def export_segmentation_frame(seg_frame: np.ndarray, frame_number: int, out_path: str):
+    # Traces every label of the frame and writes its cells and frames/{frame_number}.json collection.
+    # Returns (frame_number, the paths written).
+    frame_cells = []
+
+    # all labels of the frame are traced in one pass, each within its bounding box
+    traced = list(util.label_polygons(seg_frame))
+    cell_ids = _cell_id_index.lookup(frame_number, [label for label, _, _ in traced]).tolist()
+    for (label, polygons, (xmin, ymin, xmax, ymax)), cell_id in zip(traced, cell_ids):
+        bbox_values = [xmin, ymax, xmax, ymin]
+        for rings in polygons:
+            frame_cells.append((cell_id, util.encode_feature(rings, {"id": cell_id,'frame': frame_number}, bbox_values)))
+    return frame_number, util.export_frame_cells(out_path, frame_number, frame_cells, True, PACKED)
+
+def matlab_to_tiff_and_json(filename: str, cell_id_index: util.SegmentCellIndex, manifest: util.ConversionManifest = None):
     util.msg_header('Extracting images from ' + filename, QUIET_MODE)
     matlab_data = util.openAnyMatlabFile(IN_FOLDER + filename)
     image_data = util.getNormalizedMatlabObjectFromKey(matlab_data, 'D_stored')
     out_path = OUT_FOLDER + filename
     out_path = out_path.removesuffix('.mat') + '.tif'
+    if OME_COMPANION:
+        # the set gets its own ome folder next to where the tif would be, apart from the images/ segmentations of images.mat
+        out_path = os.path.join(os.path.dirname(out_path), 'ome', util.OME_COMPANION_FILENAME)
     util.ensure_directory_exists(out_path)
-    with tf.TiffWriter(out_path) as tif:
-         for frame in range(image_data.shape[2]):
-            util.updateLoadingMessage(frame+1, image_data.shape[2], 'frames', QUIET_MODE)
-            tif.write(image_data[:, :, frame])
-    util.return_carriage(QUIET_MODE)
+    image_extra = 'pyramid' if PYRAMID else None
+    if manifest is not None and manifest.is_current(out_path, [IN_FOLDER + filename], image_extra):
+        util.msg('unchanged since the last run.', QUIET_MODE)
+    else:
+        if OME_COMPANION:
+            writer = util.OmeTiffSetWriter(os.path.dirname(out_path), pyramid=PYRAMID)
+            write = writer.write
+        else:
+            writer = tf.TiffWriter(out_path)
+            write = partial(util.write_frame, writer, pyramid=PYRAMID)
+        with writer:
+            for frame in range(image_data.shape[2]):
+                util.updateLoadingMessage(frame+1, image_data.shape[2], 'frames', QUIET_MODE)
+                write(image_data[:, :, frame])
+        util.return_carriage(QUIET_MODE)
+        if manifest is not None:
+            output_paths = writer.output_paths if OME_COMPANION else [out_path]
+            manifest.record(out_path, [IN_FOLDER + filename], output_paths, image_extra)
 
     util.msg('saving...', QUIET_MODE, True)
     seg_data = util.getNormalizedMatlabObjectFromKey(matlab_data, 'L_stored')
@@ -106,33 +140,43 @@ def matlab_to_tiff_and_json(filename: str, cell_id_dict: Dict):
     util.msg_header('Extracting segmentations from ' + filename, QUIET_MODE)
     out_path = OUT_FOLDER + filename
     out_path = out_path.removesuffix('.mat') + '/'
-    for frame_index in range(image_data.shape[2]):
-        util.updateLoadingMessage(frame_index+1, image_data.shape[2], 'frames', QUIET_MODE)
-        frame_number = frame_index + 1
-        seg_frame = seg_data[:,:,frame_index]
-        unique_ids = set(seg_frame.flatten().tolist())
-        unique_ids.remove(0)
-        feature_list = []
-
-        for seg_id in unique_ids:
-            single_seg = seg_frame == seg_id
-            mask = Mask(single_seg)
-            polygons = mask.polygons()
-            bbox = mask.bbox()
-            bbox_values = [bbox.min_point[0], bbox.max_point[1], bbox.max_point[0], bbox.min_point[1]]
-            key = str(frame_number) + '-' + str(seg_id)
-            # print(cell_id_dict)
-            # print(key)
-            cell_id = cell_id_dict.get(key, -404)
-            # print(cell_id)
-            for polygon_verts in polygons.points:
-                outer_polygon_coords = polygon_verts.tolist()
-                outer_polygon_coords.append(outer_polygon_coords[0]) # add beginning to end to close loop
-                feature = Feature(geometry=Polygon([outer_polygon_coords]), properties={"id": cell_id,'frame': frame_number}, bbox=bbox_values)
-                util.export_file(dumps(feature), os.path.join(out_path, 'cells'), '{}-{}'.format(str(frame_number), cell_id), True)
-                feature_list.append(feature)
-
-        # util.export_file(feature_list, out_path, frame_index + 1)
+    frame_count = image_data.shape[2]
+    frame_digests = {}
+    shared_frames = {}
+
+    # Frames are read here while the workers trace the previous ones. With WORKERS > 1 each frame is handed
+    # over in shared memory, and the worker writes its cells and frame collection.
+    def frame_tasks():
+        for frame_index in range(frame_count):
+            frame_number = frame_index + 1
+            seg_frame = seg_data[:,:,frame_index]
+            if manifest is not None:
+                # the frame is unchanged when its labels and their cell ids are
+                unique_ids = np.unique(seg_frame)
+                frame_cell_ids = cell_id_index.lookup(frame_number, unique_ids[unique_ids != 0])
+                frame_digests[frame_number] = util.array_digest(seg_frame, frame_cell_ids)
+                if manifest.is_current(out_path + str(frame_number), extra=frame_digests[frame_number]):
+                    continue
+            if WORKERS > 1:
+                shared_frames[frame_number], shared = util.share_array(seg_frame)
+                yield (shared, frame_number, out_path)
+            else:
+                yield (seg_frame, frame_number, out_path)
+
+    export_frame = partial(util.call_with_shared_array, export_segmentation_frame) if WORKERS > 1 else export_segmentation_frame
+    try:
+        for frame_number, output_paths in util.ordered_map(export_frame, frame_tasks(), WORKERS, set_cell_ids, (cell_id_index,)):
+            util.updateLoadingMessage(frame_number, frame_count, 'frames', QUIET_MODE)
+            if frame_number in shared_frames:
+                shared_frames[frame_number].close()
+                shared_frames.pop(frame_number).unlink()
+            if manifest is not None:
+                manifest.record(out_path + str(frame_number), [], output_paths, frame_digests.pop(frame_number))
+    finally:
+        # frames still shared after a failure
+        for shared_frame in shared_frames.values():
+            shared_frame.close()
+            shared_frame.unlink()
     util.return_carriage(QUIET_MODE)
     util.msg('done.', QUIET_MODE)
     return
@@ -1,11 +1,10 @@
 import os
+import argparse
 import fnmatch
-from webbrowser import get
+from itertools import groupby
 from matlab_to_all import QUIET_MODE
 import util_common as util
-from roifile import ImagejRoi
-from geojson import Feature, Polygon, FeatureCollection, dumps
-from typing import Union, List
+from typing import List
 
 IN_FOLDER = './in/'
 OUT_FOLDER = './out/'
@@ -18,52 +17,61 @@ OVERWRITE = True
 # - maybe tracks folder, but probably not
 # - if remove frames folder, can maybe improve perf of overwrite = False
 
-def main():
+def main(workers: int = 1, incremental: bool = False, in_folder: str = IN_FOLDER, precision: int = util.DEFAULT_PRECISION, packed: bool = False):
     util.msg_header('Finding ROI files', QUIET_MODE)
+    # roi files are read from an ImageJ RoiSet.zip, or found in a folder
+    archive = in_folder if util.is_roi_archive(in_folder) else None
     pattern = '*.roi'
     filename_list = []
     found_count = 0
     print_every = 10
-    for root, _, files in os.walk(IN_FOLDER):
-        path = root.replace(IN_FOLDER, '', 1)
-        for name in fnmatch.filter(files, pattern):
-            filename_list.append((path, name))
-            found_count += 1
-            if found_count % print_every == 0:
-                util.msg('{} Found: {} files.'.format(util.textSpinner(found_count, 10_000), found_count), QUIET_MODE, True)
+    if archive is not None:
+        filename_list = util.list_roi_archive(archive, pattern)
+        found_count = len(filename_list)
+    else:
+        for root, _, files in os.walk(in_folder):
+            # folder of the files relative to the input, whether or not it ends with a separator
+            path = os.path.relpath(root, in_folder)
+            path = '' if path == os.curdir else path
+            for name in fnmatch.filter(files, pattern):
+                filename_list.append((path, name))
+                found_count += 1
+                if found_count % print_every == 0:
+                    util.msg('{} Found: {} files.'.format(util.textSpinner(found_count, 10_000), found_count), QUIET_MODE, True)
     filename_list.sort(key=lambda f: (f[0], parse_frame(f[1]), parse_id(f[1])))
     filename_stats = get_filename_stats(filename_list)
     util.msg('✅ Found: {} files in {} folders.'.format(found_count, len(filename_stats)), QUIET_MODE, True)
-    feature_list = []
-    last_frame = -1
     last_path = ''
     file_count = 0
     folder_count = 0
-    for path, name in filename_list:
-        frame = parse_frame(name)
+    # each frame is decoded and serialized as one unit of work, then written here in sorted order
+    frame_groups = [(path, frame, [(util.roi_file(in_folder, path, name, archive), parse_id(name)) for _, name in group])
+                    for (path, frame), group in groupby(filename_list, key=lambda f: (f[0], parse_frame(f[1])))]
+    # with incremental, frames whose roi files are unchanged since the last run are skipped
+    manifest = util.ConversionManifest(os.path.join(OUT_FOLDER, util.MANIFEST_FILENAME), settings={'precision': precision, 'packed': packed}) if incremental else None
+    is_current = [manifest is not None and manifest.is_current(os.path.join(path, 'frames', str(frame)), *util.roi_inputs([f for f, _ in roi_files], archive))
+                  for path, frame, roi_files in frame_groups]
+    results = util.ordered_map(util.convert_roi_frame, [(frame, roi_files, archive, precision) for (_, frame, roi_files), current in zip(frame_groups, is_current) if not current], workers)
+    for (path, frame, roi_files), current in zip(frame_groups, is_current):
         if path != last_path:
             folder_count += 1
             util.return_carriage(QUIET_MODE)
             util.return_carriage(QUIET_MODE)
             util.msg_header('Converting folder [{}/{}]: {}'.format(folder_count, len(filename_stats), path), QUIET_MODE)
             file_count = 0
-        file_count += 1
+        file_count += len(roi_files)
         util.updateLoadingMessage(file_count, filename_stats[path]['count'], 'files. {} of {} frames'.format(frame, filename_stats[path]['frames']), False)
-        if last_frame != frame and last_frame != -1:
-            export(feature_list, os.path.join(OUT_FOLDER, last_path, 'frames'), str(last_frame))
-            feature_list = []
-        last_frame = frame
         last_path = path
-        filename = os.path.join(IN_FOLDER, path, name)
-        cell_id = parse_id(name)
-        roi = ImagejRoi.fromfile(filename)
-        outer_polygon_coords = roi.coordinates().tolist()
-        outer_polygon_coords.append(outer_polygon_coords[0]) # add beginning to end to close loop
-        feature = Feature(geometry=Polygon([outer_polygon_coords]), properties={"id": cell_id, 'frame': frame}, bbox=[roi.left, roi.bottom, roi.right, roi.top])
-        export(feature, os.path.join(OUT_FOLDER, last_path, 'cells'), '{}-{}'.format(str(frame), cell_id))
-        feature_list.append(feature)
-
-    export(feature_list, os.path.join(OUT_FOLDER, last_path, 'frames'), str(last_frame))
+        if current:
+            continue
+        cell_jsons = next(results)
+        # each cell's json is written to its own file (or only indexed when packed) and streamed into the frame's collection
+        output_paths = util.export_frame_cells(os.path.join(OUT_FOLDER, path), frame, [(cell_id, cell_json) for (_, cell_id), cell_json in zip(roi_files, cell_jsons)], OVERWRITE, packed)
+        if manifest is not None:
+            input_paths, extra = util.roi_inputs([f for f, _ in roi_files], archive)
+            manifest.record(os.path.join(path, 'frames', str(frame)), input_paths, output_paths, extra)
+    if manifest is not None:
+        manifest.save()
 
     util.return_carriage(QUIET_MODE)
     util.return_carriage(QUIET_MODE)
@@ -81,22 +89,6 @@ def get_filename_stats(filename_list: List) -> dict:
         filename_stats[path]['frames'] = max(filename_stats[path]['frames'], frame)
     return filename_stats
 
-def feature_list_to_json(feature_list: List) -> str:
-    feature_collection = FeatureCollection(feature_list)
-    return dumps(feature_collection)
-
-def feature_to_json(feature: Feature) -> str:
-    return dumps(feature)
-
-def export(data: Union[Feature, List], full_path: str, name: str):
-    if isinstance(data, Feature):
-        data = feature_to_json(data)
-    else:
-        data = feature_list_to_json(data)
-    util.export_file(data, full_path, name, OVERWRITE)
-    return
-
-
 def parse_frame(filename: str) -> int:
     return int(filename.split('-')[0])
 
@@ -104,4 +96,11 @@ def parse_id(filename: str) -> int:
     return filename.split('-')[1].split('.')[0]
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Convert a folder of ROI files into GeoJSON segmentations.')
+    parser.add_argument('--input', default=IN_FOLDER, help='Folder or ImageJ RoiSet.zip of ROI files (default: {})'.format(IN_FOLDER))
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes converting ROI files (default: 1)')
+    parser.add_argument('--incremental', action='store_true', help='Only convert the frames whose ROI files changed since the last run')
+    parser.add_argument('--precision', type=int, default=util.DEFAULT_PRECISION, help='Decimals kept in coordinates, 0 writes integers (default: {})'.format(util.DEFAULT_PRECISION))
+    parser.add_argument('--packed', action='store_true', help='Write the cells of each frame into one file with a byte range index, instead of one file per cell')
+    args = parser.parse_args()
+    main(args.workers, args.incremental, args.input, args.precision, args.packed)
\ No newline at end of file
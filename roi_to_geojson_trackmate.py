@@ -2,9 +2,7 @@ import os
 import fnmatch
 from matlab_to_all import QUIET_MODE
 import util_common as util
-from roifile import ImagejRoi
-from geojson import Feature, Polygon, FeatureCollection, dumps
-from typing import Union, List
+from typing import List
 import pandas as pd
 
 IN_FOLDER = "./in/"
@@ -12,6 +10,8 @@ OUT_FOLDER = "./out/"
 
 QUIET_MODE = False
 OVERWRITE = True
+PRECISION = util.DEFAULT_PRECISION  # decimals kept in coordinates, 0 writes integers
+PACKED = False  # index the cells inside frames/{frame}.json instead of writing one file per cell
 
 
 REFERENCE_TABLE = "./in/reference_table.csv"
@@ -42,20 +42,19 @@ def main():
                     QUIET_MODE,
                     True,
                 )
-    filename_list.sort(key=lambda f: (f[0], parse_frame(f[1]), parse_id(f[1])))
+    filename_list = parse_frames(filename_list)
     filename_stats = get_filename_stats(filename_list)
     util.msg(
         "✅ Found: {} files in {} folders.".format(found_count, len(filename_stats)),
         QUIET_MODE,
         True,
     )
-    feature_list = []
+    frame_writer = None
     last_frame = -1
     last_path = ""
     file_count = 0
     folder_count = 0
-    for path, name in filename_list:
-        frame = parse_frame(name)
+    for path, frame, name in filename_list:
         if path != last_path:
             folder_count += 1
             util.return_carriage(QUIET_MODE)
@@ -74,35 +73,33 @@ def main():
             "files. {} of {} frames".format(frame, filename_stats[path]["frames"]),
             False,
         )
-        if last_frame != frame and last_frame != -1:
-            export(
-                feature_list,
-                os.path.join(OUT_FOLDER, last_path, "frames"),
-                str(last_frame),
+        if last_frame != frame or last_path != path:
+            # each frame's collection is streamed to disk as its cells are converted
+            if frame_writer is not None:
+                frame_writer.close()
+            frame_writer = util.FeatureCollectionWriter(
+                os.path.join(OUT_FOLDER, path, "frames"),
+                str(frame),
+                OVERWRITE,
+                os.path.join(OUT_FOLDER, path, "cells") if PACKED else None,
             )
-            feature_list = []
         last_frame = frame
         last_path = path
         filename = os.path.join(IN_FOLDER, path, name)
         cell_id = parse_id(name)
-        roi = ImagejRoi.fromfile(filename)
-        outer_polygon_coords = roi.coordinates().tolist()
-        outer_polygon_coords.append(
-            outer_polygon_coords[0]
-        )  # add beginning to end to close loop
-        feature = Feature(
-            geometry=Polygon([outer_polygon_coords]),
-            properties={"id": cell_id, "frame": frame},
-            bbox=[roi.left, roi.bottom, roi.right, roi.top],
-        )
-        export(
-            feature,
-            os.path.join(OUT_FOLDER, last_path, "cells"),
-            "{}-{}".format(str(frame), cell_id),
-        )
-        feature_list.append(feature)
+        # serialize once, the same json goes to the cell file and the frame collection
+        feature_json = util.roi_to_json(filename, cell_id, frame, precision=PRECISION)
+        if not PACKED:
+            util.export_file(
+                feature_json,
+                os.path.join(OUT_FOLDER, path, "cells"),
+                "{}-{}".format(str(frame), cell_id),
+                OVERWRITE,
+            )
+        frame_writer.write(feature_json, cell_id)
 
-    export(feature_list, os.path.join(OUT_FOLDER, last_path, "frames"), str(last_frame))
+    if frame_writer is not None:
+        frame_writer.close()
 
     util.return_carriage(QUIET_MODE)
     util.return_carriage(QUIET_MODE)
@@ -112,8 +109,7 @@ def main():
 
 def get_filename_stats(filename_list: List) -> dict:
     filename_stats = {}
-    for path, name in filename_list:
-        frame = parse_frame(name)
+    for path, frame, name in filename_list:
         if path not in filename_stats:
             filename_stats[path] = {"count": 0, "frames": 0}
         filename_stats[path]["count"] += 1
@@ -121,35 +117,13 @@ def get_filename_stats(filename_list: List) -> dict:
     return filename_stats
 
 
-def feature_list_to_json(feature_list: List) -> str:
-    feature_collection = FeatureCollection(feature_list)
-    return dumps(feature_collection)
-
-
-def feature_to_json(feature: Feature) -> str:
-    return dumps(feature)
-
-
-def export(data: Union[Feature, List], full_path: str, name: str):
-    if isinstance(data, Feature):
-        data = feature_to_json(data)
-    else:
-        data = feature_list_to_json(data)
-    util.export_file(data, full_path, name, OVERWRITE)
-    return
-
-
-def parse_frame(filename: str) -> int:
-    # get frame from the reference table
-    track_id = parse_id(filename)
-    if "-" not in filename:
-        cell_index = 0
-    else:
-        cell_index = int(filename.split("-")[1].split(".")[0])
-    frames = df.loc[df["LABEL"] == track_id, "FRAME"]
-    sorted_frames = sorted(frames.tolist())
-    frame = sorted_frames[cell_index]
-    return frame
+def parse_frames(filename_list: List) -> List:
+    # get frames from the reference table, grouped by track once
+    frame_index = util.TrackFrameIndex(df, "LABEL", "FRAME")
+    frames = frame_index.resolve([name for _, name in filename_list])
+    manifest = [(path, int(f), name) for (path, name), f in zip(filename_list, frames)]
+    manifest.sort(key=lambda m: (m[0], m[1], parse_id(m[2])))
+    return manifest
 
 
 def parse_id(filename: str) -> int:
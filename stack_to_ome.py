@@ -0,0 +1,32 @@
+'''
+Splits the image_stack.tif of every location of a converted experiment into images/image_t{t}.ome.tiff files and
+images/images.companion.ome, as batch_bfconvert.sh did with bfconvert, without starting a JVM per location.
+'''
+import os
+import argparse
+import glob
+import util_common as util
+
+PATH_ROOT = './out/MCF7DrugResponsePanelA_cellgrowthutiltes/'
+STACK_FILENAME = 'image_stack.tif'
+
+def convert_stack(stack_filename: str, pyramid: bool = False) -> str:
+    images_folder = os.path.join(os.path.dirname(stack_filename), 'images')
+    util.write_ome_tiff_set(util.read_tiff_frames(stack_filename), images_folder, pyramid=pyramid)
+    return images_folder
+
+def main(path_root: str = PATH_ROOT, workers: int = 1, pyramid: bool = False):
+    stack_filenames = sorted(glob.glob(os.path.join(path_root, 'loc_*', STACK_FILENAME)))
+    util.msg_header('Converting {} image stacks'.format(len(stack_filenames)))
+    for count, images_folder in enumerate(util.ordered_map(convert_stack, [(filename, pyramid) for filename in stack_filenames], workers), start=1):
+        util.updateLoadingMessage(count, len(stack_filenames), 'locations. {}'.format(images_folder), False)
+    util.return_carriage(False)
+    util.msg_header('Done 🥂')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert the image_stack.tif of each location into an OME-TIFF set with a companion file.')
+    parser.add_argument('path_root', nargs='?', default=PATH_ROOT, help='Experiment folder with one loc_* folder per location (default: {})'.format(PATH_ROOT))
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes converting locations (default: 1)')
+    parser.add_argument('--pyramid', action='store_true', help='Write tiled, compressed frames with reduced resolutions')
+    args = parser.parse_args()
+    main(args.path_root, args.workers, args.pyramid)
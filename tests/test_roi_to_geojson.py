@@ -0,0 +1,31 @@
+import json
+import os
+import sys
+
+import numpy as np
+from roifile import ImagejRoi
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import roi_to_geojson
+
+
+def write_roi(folder, name, points):
+    os.makedirs(folder, exist_ok=True)
+    ImagejRoi.frompoints(np.array(points)).tofile(os.path.join(folder, name))
+
+
+def test_input_folder_without_trailing_separator(tmp_path, monkeypatch):
+    in_folder = tmp_path / 'in'
+    out_folder = tmp_path / 'out'
+    write_roi(in_folder / 'f1', '1-1.roi', [[1, 1], [5, 1], [5, 5]])
+    write_roi(in_folder, '2-3.roi', [[2, 2], [6, 2], [6, 6]])
+    monkeypatch.setattr(roi_to_geojson, 'OUT_FOLDER', str(out_folder) + os.sep)
+    monkeypatch.setattr(roi_to_geojson, 'QUIET_MODE', True)
+
+    roi_to_geojson.main(in_folder=str(in_folder))
+
+    with open(out_folder / 'f1' / 'frames' / '1.json') as frame_file:
+        assert len(json.load(frame_file)['features']) == 1
+    assert (out_folder / 'f1' / 'cells' / '1-1.json').exists()
+    assert (out_folder / 'frames' / '2.json').exists()
+    assert (out_folder / 'cells' / '2-3.json').exists()
@@ -1,10 +1,27 @@
+import fnmatch
+import hashlib
+import json
 import math
 import os
-from typing import Union, List
+import posixpath
+import uuid
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Callable, Iterable, Iterator, Union, List, Tuple
+import cv2
 import h5py
+from scipy import ndimage
 from scipy.io import loadmat
 import numpy as np
-from geojson import FeatureCollection, dumps
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import tifffile as tf
+import ome_types
+import ome_types.model as ome
+from roifile import ImagejRoi
 
 def openAnyMatlabFile(matlabFilename: str) -> Union[dict, h5py.File]:
     try:
@@ -13,6 +30,47 @@ def openAnyMatlabFile(matlabFilename: str) -> Union[dict, h5py.File]:
         outputDict = loadmat(matlabFilename)
     return outputDict
 
+class TransposedDataset:
+    '''
+    An h5py dataset seen with its axes reversed, as MATLAB stores them, that reads only what is indexed.
+    stack[:, :, t] reads the one frame t from the file and returns it as a contiguous array, so a
+    stack never has to fit in memory. Indexing takes integers and slices, one per axis or fewer.
+    '''
+    def __init__(self, matlab_file: h5py.File, key: str):
+        dataset = matlab_file[key]
+        self.shape = dataset.shape[::-1]
+        self.dtype = dataset.dtype
+        self.ndim = dataset.ndim
+        access = _frame_chunk_cache(dataset)
+        # HDF5 shares an open dataset between handles, so the cache settings only apply to the first open
+        del dataset
+        self.dataset = h5py.Dataset(h5py.h5d.open(matlab_file.id, key.encode(), access))
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __getitem__(self, key) -> np.ndarray:
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (self.ndim - len(key))
+        return np.ascontiguousarray(self.dataset[key[::-1]].T)
+
+    def __array__(self, dtype=None) -> np.ndarray:
+        return np.asarray(self.dataset[()].T, dtype=dtype)
+
+def _frame_chunk_cache(dataset: h5py.Dataset):
+    # Dataset access with a chunk cache that holds all the chunks of one frame (the first axis in the file,
+    # the last one in MATLAB). When chunks span several frames they are then decompressed once, not once per frame.
+    access = h5py.h5p.create(h5py.h5p.DATASET_ACCESS)
+    if dataset.chunks is None:
+        return access
+    chunk_bytes = int(np.prod(dataset.chunks)) * dataset.dtype.itemsize
+    chunks_per_frame = int(np.prod([math.ceil(size / chunk) for size, chunk in zip(dataset.shape[1:], dataset.chunks[1:])]))
+    cache_bytes = max(chunk_bytes * chunks_per_frame, 1 << 20)
+    # hash slots well above the number of cached chunks, and evict fully read chunks first
+    access.set_chunk_cache(100 * chunks_per_frame + 1, cache_bytes, 1.0)
+    return access
+
 def getNormalizedMatlabObjectFromKey(matlabDict: Union[dict, h5py.File], key: str):
     if key not in matlabDict:
         return None
@@ -21,8 +79,29 @@ def getNormalizedMatlabObjectFromKey(matlabDict: Union[dict, h5py.File], key: st
         # return np.array(matlabDict[key]).T
     # else it is an h5py file, which has to be transposed
     # (https://www.mathworks.com/matlabcentral/answers/308303-why-does-matlab-transpose-hdf5-data)
+    if issubclass(matlabDict.get(key, getclass=True), h5py.Dataset):
+        # read lazily, a frame at a time, as the image and label stacks can be larger than memory
+        return TransposedDataset(matlabDict, key)
     return np.array(matlabDict[key]).T
 
+def getMatlabStructFields(matlabDict: Union[dict, h5py.File], key: str, fields: List[str]) -> dict:
+    # Values of the given fields for every element of the struct array stored under key: field -> one array per
+    # element, oriented as loadmat gives them. In MATLAB v7.3 files each value is an object reference in the field's
+    # dataset, dereferenced and transposed here.
+    if type(matlabDict) == dict:
+        structs = matlabDict[key].ravel()
+        return {field: list(structs[field]) for field in fields}
+    group = matlabDict[key]
+    values = {}
+    for field in fields:
+        dataset = group[field]
+        if h5py.check_ref_dtype(dataset.dtype) is None:
+            # a single struct stores its values inline
+            values[field] = [np.array(dataset).T]
+            continue
+        values[field] = [np.array(matlabDict[reference]).T for reference in dataset[()].ravel()]
+    return values
+
 def err(msg: str) -> None:
     print('🟥──ERROR──🟥:', msg)
     return
@@ -95,9 +174,670 @@ def export_file(data: str, full_path: str, name: str, overwrite: bool = False):
     return
 
 
+def _builtin(value):
+    # numpy scalars as the python int/float json can encode
+    return value.item() if isinstance(value, np.generic) else value
+
+# geojson rounds coordinates to 6 decimals when encoding, so that is the default here too
+DEFAULT_PRECISION = 6
+
+def encode_ring(ring: np.ndarray, precision: int = DEFAULT_PRECISION) -> str:
+    # Encodes an (n, 2) coordinate array as a closed GeoJSON linear ring: the first point is repeated at the end.
+    # Float coordinates are rounded to precision decimals (None keeps them as they are) and a precision
+    # of 0 quantizes them to integers. Integer arrays are written as they are.
+    ring = np.asarray(ring)
+    if len(ring) == 0:
+        return '[]'
+    ring = np.concatenate([ring, ring[:1]]) # add beginning to end to close loop
+    if precision is not None and ring.dtype.kind == 'f':
+        ring = np.round(ring.astype(np.float64), precision)
+        if precision <= 0:
+            ring = ring.astype(np.int64)
+    if ring.dtype.kind in 'iub':
+        value_format = '%d'
+    elif np.isfinite(ring).all() and (ring == np.trunc(ring)).all() and (np.abs(ring) < 1e16).all() and not (np.signbit(ring) & (ring == 0)).any():
+        # integral floats, as most ImageJ coordinates are, print as 12.0 without going through repr (which keeps -0.0)
+        value_format = '%d.0'
+        ring = ring.astype(np.int64)
+    else:
+        value_format = '%r'
+        ring = ring.astype(np.float64)
+    point_format = '[' + value_format + ', ' + value_format + ']'
+    return '[' + ', '.join([point_format] * len(ring)) % tuple(ring.ravel().tolist()) + ']'
+
+def encode_feature(rings: List[np.ndarray], properties: dict, bbox: list = None, precision: int = DEFAULT_PRECISION) -> str:
+    # Writes a Polygon Feature (outer ring first, then any holes) straight from numpy coordinate arrays,
+    # laid out exactly as geojson.dumps(Feature(geometry=Polygon(...), properties=..., bbox=...)).
+    feature_json = '{"type": "Feature", '
+    if bbox is not None:
+        feature_json += '"bbox": ' + json.dumps([_builtin(value) for value in bbox]) + ', '
+    feature_json += '"geometry": {"type": "Polygon", "coordinates": [' + ', '.join(encode_ring(ring, precision) for ring in rings) + ']}, '
+    feature_json += '"properties": ' + json.dumps({key: _builtin(value) for key, value in properties.items()}) + '}'
+    return feature_json
+
+# In packed mode the cells of a frame are not written to their own files. cells/{frame}.index.json
+# gives the byte range of every cell inside frames/{frame}.json instead, so that a single cell
+# can still be fetched with an HTTP range request.
+CELL_INDEX_SUFFIX = '.index.json'
+
+class FeatureCollectionWriter:
+    '''
+    Streams a GeoJSON FeatureCollection to full_path/name.json one serialized feature at a time, so the
+    json written for each cell is reused as is and a frame never has to be encoded again as a whole.
+    The output is the same as dumps(FeatureCollection(features)).
+    With an index_folder, the byte range of each cell is written to index_folder/name.index.json on close.
+    '''
+    def __init__(self, full_path: str, name: str, overwrite: bool = False, index_folder: str = None):
+        self.feature_count = 0
+        self.out_file = None
+        self.save_path = os.path.join(full_path, name + '.json')
+        self.index_path = None if index_folder is None else os.path.join(index_folder, name + CELL_INDEX_SUFFIX)
+        self.cell_ranges = {}
+        if not overwrite and os.path.exists(self.save_path):
+            return
+        ensure_directory_exists(self.save_path)
+        self.out_file = open(self.save_path, 'wb')
+        self.offset = self._write('{"type": "FeatureCollection", "features": [')
+
+    def _write(self, data: str) -> int:
+        return self.out_file.write(data.encode())
+
+    def write(self, feature_json: str, cell_id=None):
+        if self.out_file is None:
+            return
+        if self.feature_count > 0:
+            self.offset += self._write(', ')
+        length = self._write(feature_json)
+        if self.index_path is not None:
+            # like the cells/ files, a cell id written twice in a frame keeps its last feature
+            self.cell_ranges[str(cell_id)] = [self.offset, length]
+        self.offset += length
+        self.feature_count += 1
+
+    def close(self):
+        if self.out_file is None:
+            return
+        self._write(']}')
+        self.out_file.close()
+        self.out_file = None
+        if self.index_path is not None:
+            frames_file = os.path.relpath(self.save_path, os.path.dirname(self.index_path)).replace(os.sep, '/')
+            ensure_directory_exists(self.index_path)
+            with open(self.index_path, 'w') as index_file:
+                json.dump({'file': frames_file, 'cells': self.cell_ranges}, index_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def export_frame_cells(folder: str, frame: int, cells: Iterable[Tuple[object, str]], overwrite: bool = False,
+                       packed: bool = False, frame_collection: bool = True) -> List[str]:
+    # Writes the (cell_id, json) of every cell of a frame under folder: one cells/{frame}-{cell_id}.json per cell,
+    # and frames/{frame}.json with all of them when frame_collection is set. In packed mode only frames/{frame}.json
+    # and its cells/{frame}.index.json are written. Returns the paths of the frame's files: the ones written, and
+    # without overwrite the ones kept as they were, so a manifest recording them does not take them for stale.
+    # An index that was neither written nor kept is left out.
+    cells_folder = os.path.join(folder, 'cells')
+    output_paths = []
+    frame_writer = None
+    if frame_collection or packed:
+        frame_writer = FeatureCollectionWriter(os.path.join(folder, 'frames'), str(frame), overwrite, cells_folder if packed else None)
+        output_paths.append(frame_writer.save_path)
+        if packed and (frame_writer.out_file is not None or os.path.exists(frame_writer.index_path)):
+            output_paths.append(frame_writer.index_path)
+    for cell_id, cell_json in cells:
+        if not packed:
+            name = '{}-{}'.format(str(frame), cell_id)
+            export_file(cell_json, cells_folder, name, overwrite)
+            output_paths.append(os.path.join(cells_folder, name + '.json'))
+        if frame_writer is not None:
+            frame_writer.write(cell_json, cell_id)
+    if frame_writer is not None:
+        frame_writer.close()
+    return output_paths
+
+
 def ensure_directory_exists(path: str):
     # Creates directory in path if it doesn't exist
     # path can include filename
     dir_path = os.path.dirname(path)
     if not os.path.exists(dir_path):
-        os.makedirs(dir_path, exist_ok=True)
\ No newline at end of file
+        os.makedirs(dir_path, exist_ok=True)
+
+PYRAMID_TILE_SIZE = 256
+PYRAMID_COMPRESSION = 'zlib' # lossless, and needs no codec beyond the standard library
+
+def pyramid_levels(frame: np.ndarray) -> List[np.ndarray]:
+    # reduced resolutions of a frame, each half the size of the previous one (2x2 means), down to a single tile
+    levels = []
+    while max(frame.shape[:2]) > PYRAMID_TILE_SIZE:
+        padded = np.pad(frame, ((0, frame.shape[0] % 2), (0, frame.shape[1] % 2)), mode='edge')
+        half = padded.reshape(padded.shape[0] // 2, 2, padded.shape[1] // 2, 2).mean(axis=(1, 3))
+        frame = np.rint(half).astype(frame.dtype) if np.issubdtype(frame.dtype, np.integer) else half.astype(frame.dtype)
+        levels.append(frame)
+    return levels
+
+def write_frame(tif: tf.TiffWriter, frame: np.ndarray, pyramid: bool = False, **kwargs):
+    # Writes a frame as one page. With pyramid, the page is tiled and compressed, and its reduced resolutions
+    # follow as SubIFDs, so a viewer zoomed out or panning only reads and decodes the tiles it shows.
+    if not pyramid:
+        tif.write(frame, **kwargs)
+        return
+    levels = pyramid_levels(frame)
+    # the horizontal differencing predictor helps integer images compress, floats would need a codec
+    options = {'tile': (PYRAMID_TILE_SIZE, PYRAMID_TILE_SIZE), 'compression': PYRAMID_COMPRESSION,
+               'predictor': np.issubdtype(frame.dtype, np.integer)}
+    tif.write(frame, subifds=len(levels), **options, **kwargs)
+    for level in levels:
+        tif.write(level, subfiletype=1, **options)
+
+OME_COMPANION_FILENAME = 'images.companion.ome'
+# OME-XML pixel type of each numpy dtype an OME-TIFF can hold. 64-bit integers have none.
+OME_PIXEL_TYPES = {'bool': 'bit', 'int8': 'int8', 'int16': 'int16', 'int32': 'int32', 'uint8': 'uint8', 'uint16': 'uint16',
+                   'uint32': 'uint32', 'float32': 'float', 'float64': 'double', 'complex64': 'complex', 'complex128': 'double-complex'}
+
+class OmeTiffSetWriter:
+    '''
+    Writes frames to {folder}/image_t{t}.ome.tiff, one frame per file, and on close the {folder}/images.companion.ome
+    describing them as one time series, like bfconvert -option ometiff.companion does for a multi-page tif.
+    Each frame's file only holds a BinaryOnly OME-XML pointing to the companion file. With pyramid, frames are
+    written tiled and compressed with their reduced resolutions, see write_frame.
+    '''
+    def __init__(self, folder: str, name: str = 'images', pyramid: bool = False):
+        self.folder = folder
+        self.name = name
+        self.pyramid = pyramid
+        self.companion_uuid = 'urn:uuid:{}'.format(uuid.uuid4())
+        self.tiff_data = []
+        self.frame_shape = None
+        self.dtype = None
+        self.output_paths = []
+        os.makedirs(folder, exist_ok=True)
+
+    def write(self, frame: np.ndarray) -> str:
+        frame = np.asarray(frame)
+        if self.frame_shape is None:
+            # checked before any file is written, so an unsupported stack leaves no partial set behind
+            if frame.dtype.name not in OME_PIXEL_TYPES:
+                raise ValueError('{} frames have no OME pixel type, convert them to one of {} before writing to {}'.format(
+                    frame.dtype, ', '.join(OME_PIXEL_TYPES), self.folder))
+            self.frame_shape, self.dtype = frame.shape, frame.dtype
+        elif frame.shape != self.frame_shape or frame.dtype != self.dtype:
+            raise ValueError('Frame {} of {} is {} {}, the first frame was {} {}'.format(
+                len(self.tiff_data), self.folder, frame.shape, frame.dtype, self.frame_shape, self.dtype))
+        t = len(self.tiff_data)
+        filename = 'image_t{}.ome.tiff'.format(t)
+        file_uuid = 'urn:uuid:{}'.format(uuid.uuid4())
+        description = ome_types.to_xml(ome.OME(uuid=file_uuid, binary_only=ome.OME.BinaryOnly(
+            metadata_file=OME_COMPANION_FILENAME, uuid=self.companion_uuid)))
+        path = os.path.join(self.folder, filename)
+        with tf.TiffWriter(path, ome=False) as tif:
+            write_frame(tif, frame, self.pyramid, description=description, metadata=None)
+        self.tiff_data.append(ome.TiffData(uuid={'value': file_uuid, 'file_name': filename}, first_t=t, ifd=0, plane_count=1))
+        self.output_paths.append(path)
+        return path
+
+    def close(self) -> List[str]:
+        # writes the companion file, returns the paths of every file written
+        if self.frame_shape is None:
+            raise ValueError('No frames were written to {}'.format(self.folder))
+        pixels = ome.Pixels(id='Pixels:0', dimension_order='XYZCT', type=OME_PIXEL_TYPES[self.dtype.name],
+                            size_x=self.frame_shape[1], size_y=self.frame_shape[0], size_z=1, size_c=1, size_t=len(self.tiff_data),
+                            channels=[ome.Channel(id='Channel:0:0', samples_per_pixel=1)], tiff_data_blocks=self.tiff_data)
+        companion = ome.OME(uuid=self.companion_uuid, images=[ome.Image(id='Image:0', name=self.name, pixels=pixels)])
+        path = os.path.join(self.folder, OME_COMPANION_FILENAME)
+        with open(path, 'w') as f:
+            f.write(ome_types.to_xml(companion))
+        self.output_paths.append(path)
+        return self.output_paths
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        # the companion is only written for a complete series
+        if exc_type is None:
+            self.close()
+
+def write_ome_tiff_set(frames: Iterable[np.ndarray], folder: str, name: str = 'images', pyramid: bool = False) -> List[str]:
+    # Writes each frame of frames to its own OME-TIFF with a companion file, returns the paths written
+    with OmeTiffSetWriter(folder, name, pyramid) as writer:
+        for frame in frames:
+            writer.write(frame)
+    return writer.output_paths
+
+def read_tiff_frames(filename: str) -> Iterator[np.ndarray]:
+    # pages of a multi-page tif, one at a time
+    with tf.TiffFile(filename) as tif:
+        for page in tif.pages:
+            yield page.asarray()
+
+# TrackMate names the nth spot (ordered by frame) of a track {label}-{n}.roi, and the first one simply {label}.roi
+ROI_NAME_PATTERN = r'^(?P<track>.*?)(?:-(?P<index>\d+))?$'
+
+def split_roi_filenames(filenames: List[str]) -> pd.DataFrame:
+    # Returns a 'track' and 'index' column for every ROI filename in one vectorized pass
+    stems = pd.Series(list(filenames), dtype=object).str.replace(r'\.roi$', '', regex=True)
+    parts = stems.str.extract(ROI_NAME_PATTERN)
+    parts['index'] = parts['index'].fillna('0').astype(int)
+    return parts
+
+class TrackFrameIndex:
+    '''
+    Sorted frame numbers of every track label in a table, built once so that
+    ROI filenames resolve to frames without scanning the table per file.
+    '''
+    def __init__(self, df: pd.DataFrame, label_column: str, frame_column: str):
+        ordered = df[[label_column, frame_column]].dropna(subset=[label_column])
+        ordered = ordered.sort_values([label_column, frame_column], kind='mergesort')
+        labels = ordered[label_column].to_numpy()
+        self.frames = ordered[frame_column].to_numpy()
+        starts = np.flatnonzero(labels[1:] != labels[:-1]) + 1
+        if len(labels) > 0:
+            starts = np.concatenate(([0], starts))
+        counts = np.diff(np.append(starts, len(labels)))
+        self.starts = pd.Series(starts, index=labels[starts])
+        self.counts = pd.Series(counts, index=labels[starts])
+
+    def resolve(self, filenames: List[str]) -> np.ndarray:
+        # Frame number of every ROI filename, in the same order
+        parts = split_roi_filenames(filenames)
+        starts = parts['track'].map(self.starts)
+        counts = parts['track'].map(self.counts)
+        missing = starts.isna() | (parts['index'] >= counts)
+        if missing.any():
+            first = parts.index[missing.to_numpy()][0]
+            raise KeyError('No table row for ROI file {} ({} unresolved)'.format(list(filenames)[first], int(missing.sum())))
+        positions = starts.to_numpy(dtype=np.int64) + parts['index'].to_numpy(dtype=np.int64)
+        return self.frames[positions].astype(int)
+
+class SegmentCellIndex:
+    '''
+    Cell id of every (location, frame, segment label) of a table, sorted once so that all the labels of a
+    frame resolve in one numpy lookup instead of a string-keyed dict built per location. As with such a dict,
+    the last row wins when a segment appears twice.
+    '''
+    def __init__(self, df: pd.DataFrame, frame_column: str, label_column: str, cell_column: str,
+                 location_column: str = None, missing: int = -404):
+        self.missing = missing
+        columns = [frame_column, label_column, cell_column] + ([location_column] if location_column else [])
+        rows = df[columns].dropna()
+        frames = rows[frame_column].to_numpy().astype(np.int64)
+        labels = rows[label_column].to_numpy().astype(np.int64)
+        locations = rows[location_column].to_numpy().astype(np.int64) if location_column else np.zeros(len(rows), dtype=np.int64)
+        order = np.lexsort((labels, frames, locations))
+        frames, labels, locations = frames[order], labels[order], locations[order]
+        self.labels = labels
+        self.cells = rows[cell_column].to_numpy().astype(np.int64)[order]
+        # (location, frame) -> (start, stop) of its labels in the sorted arrays
+        starts = np.flatnonzero((np.diff(locations) != 0) | (np.diff(frames) != 0)) + 1
+        if len(labels) > 0:
+            starts = np.concatenate(([0], starts))
+        stops = np.append(starts[1:], len(labels)).astype(np.int64)
+        self.groups = dict(zip(zip(locations[starts].tolist(), frames[starts].tolist()), zip(starts.tolist(), stops.tolist())))
+
+    def lookup(self, frame: int, labels: np.ndarray, location: int = 0) -> np.ndarray:
+        # cell id of each label of a frame, or missing
+        labels = np.asarray(labels, dtype=np.int64)
+        cell_ids = np.full(len(labels), self.missing, dtype=np.int64)
+        start, stop = self.groups.get((int(location), int(frame)), (0, 0))
+        frame_labels = self.labels[start:stop]
+        # the last of equal labels, as the sort is stable
+        positions = np.searchsorted(frame_labels, labels, side='right') - 1
+        found = positions >= 0
+        found[found] = frame_labels[positions[found]] == labels[found]
+        cell_ids[found] = self.cells[start + positions[found]]
+        return cell_ids
+
+def infer_parent_labels(labels: pd.Series) -> pd.Series:
+    # TrackMate branch labels append one letter per division (Track_1 -> Track_1.a -> Track_1.ab),
+    # so the parent label drops the last letter and any trailing '.'.
+    # Labels without a '.', or whose parent is not itself a label, are their own parent.
+    candidates = labels.str[:-1].str.rstrip('.')
+    is_branch = labels.str.contains('.', regex=False).fillna(False).astype(bool)
+    exists = candidates.isin(pd.unique(labels))
+    return candidates.where(is_branch & exists, labels)
+
+def ordered_map(func: Callable, argument_list: Iterable[Tuple], workers: int = 1, initializer: Callable = None, initargs: Tuple = ()) -> Iterator:
+    # Calls func(*arguments) for each entry, in a process pool when workers > 1.
+    # Results are yielded in input order so outputs do not depend on the worker count.
+    # argument_list is consumed as workers free up, so a generator producing it runs alongside them.
+    # initializer(*initargs) sets up each worker process, or this one when running serially.
+    if workers <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for arguments in argument_list:
+            yield func(*arguments)
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs) as pool:
+        pending = deque()
+        for arguments in argument_list:
+            pending.append(pool.submit(func, *arguments))
+            # bound the results waiting on the writer
+            if len(pending) >= workers * 4:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def share_array(array: np.ndarray) -> Tuple[shared_memory.SharedMemory, Tuple[str, tuple, str]]:
+    # Copies array into a new shared memory block, so worker processes can read it without pickling.
+    # Returns the block, to unlink once the workers are done with it, and the (name, shape, dtype) to pass them.
+    block = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+    np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+    return block, (block.name, array.shape, array.dtype.str)
+
+def call_with_shared_array(func: Callable, shared: Tuple[str, tuple, str], *args):
+    # func(array, *args) on the array of a block made by share_array, without copying it
+    name, shape, dtype = shared
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        return func(np.ndarray(shape, np.dtype(dtype), buffer=block.buf), *args)
+    finally:
+        block.close()
+
+_roi_archives = {} # open RoiSet.zip files, by filename and process
+
+def is_roi_archive(roi_folder: str) -> bool:
+    return os.path.isfile(roi_folder) and zipfile.is_zipfile(roi_folder)
+
+def open_roi_archive(archive: str) -> zipfile.ZipFile:
+    # one handle per process, so forked workers do not share the file position of their parent
+    key = (archive, os.getpid())
+    if key not in _roi_archives:
+        _roi_archives[key] = zipfile.ZipFile(archive)
+    return _roi_archives[key]
+
+def list_roi_archive(archive: str, pattern: str) -> List[Tuple[str, str]]:
+    # (folder, filename) of every member of an ImageJ RoiSet.zip matching pattern
+    filename_list = []
+    for member in open_roi_archive(archive).namelist():
+        path, name = posixpath.split(member)
+        if fnmatch.fnmatch(name, pattern):
+            filename_list.append((path, name))
+    return filename_list
+
+def roi_file(roi_folder: str, path: str, name: str, archive: str = None) -> str:
+    # member name inside the archive, otherwise the path of the file
+    if archive is not None:
+        return posixpath.join(path, name)
+    return os.path.join(roi_folder, path, name)
+
+def roi_inputs(filenames: List[str], archive: str = None) -> Tuple[List[str], str]:
+    # manifest inputs of ROI files: the files themselves, or the checksums of the archive members
+    if archive is None:
+        return filenames, None
+    roi_archive = open_roi_archive(archive)
+    return [], ','.join('{}:{:08x}'.format(filename, roi_archive.getinfo(filename).CRC) for filename in filenames)
+
+def read_roi(filename: str, archive: str = None) -> ImagejRoi:
+    if archive is None:
+        return ImagejRoi.fromfile(filename)
+    return ImagejRoi.frombytes(open_roi_archive(archive).read(filename))
+
+def roi_to_json(filename: str, cell_id, frame: int, archive: str = None, precision: int = DEFAULT_PRECISION) -> str:
+    roi = read_roi(filename, archive)
+    return encode_feature([roi.coordinates()], {"id": cell_id, 'frame': frame}, [roi.left, roi.bottom, roi.right, roi.top], precision)
+
+def convert_roi_frame(frame: int, roi_files: List[Tuple[str, str]], archive: str = None, precision: int = DEFAULT_PRECISION) -> List[str]:
+    # Given the (filename, cell_id) of every ROI in a frame, returns the json of each cell.
+    # Filenames are members of the archive when one is given.
+    return [roi_to_json(filename, cell_id, frame, archive, precision) for filename, cell_id in roi_files]
+
+def _trace_mask(mask: np.ndarray, x_offset: int, y_offset: int) -> List[List[np.ndarray]]:
+    # Contours of a 0/1 uint8 mask padded by one pixel on each side, with (x_offset, y_offset) the image position
+    # of its first unpadded pixel. Contours are traced as imantics' Mask.polygons() does, so a shape without holes
+    # gets the same rings. Returns each polygon as a list of (n, 2) x,y rings, the outer one first and then its holes.
+    contours, hierarchy = cv2.findContours(mask, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE, offset=(x_offset - 1, y_offset - 1))[-2:]
+    # two level hierarchy: outer contours have no parent, and holes have their outer contour as parent
+    polygons = {}
+    for contour_index, contour in enumerate(contours):
+        if hierarchy[0][contour_index][3] < 0:
+            polygons[contour_index] = [contour.reshape(-1, 2)]
+    for contour_index, contour in enumerate(contours):
+        parent = hierarchy[0][contour_index][3]
+        if parent >= 0:
+            polygons[parent].append(contour.reshape(-1, 2))
+    return list(polygons.values())
+
+def label_polygons(label_image: np.ndarray) -> Iterator[Tuple[int, List[List[np.ndarray]], Tuple[int, int, int, int]]]:
+    # Traces every label of a 2D label image (0 is background) in one pass, in increasing label order.
+    # Each label is only compared and traced inside its own bounding box, found for all labels at once,
+    # instead of building a full frame mask per label. Yields (label, polygons, bbox) where polygons are
+    # as _trace_mask returns them and bbox is (xmin, ymin, xmax, ymax) inclusive.
+    label_image = np.asarray(label_image)
+    if label_image.dtype.kind not in 'iu':
+        label_image = label_image.astype(np.int64)
+    for index, object_slice in enumerate(ndimage.find_objects(label_image)):
+        if object_slice is None:
+            continue
+        label = index + 1
+        rows, cols = object_slice
+        # padded so contours touching the crop edge are closed, as imantics pads the full frame
+        crop = np.pad((label_image[object_slice] == label).astype(np.uint8), 1)
+        yield label, _trace_mask(crop, cols.start, rows.start), (cols.start, rows.start, cols.stop - 1, rows.stop - 1)
+
+def run_polygons(rows: np.ndarray, starts: np.ndarray, lengths: np.ndarray, labels: np.ndarray) -> Iterator[Tuple[int, List[List[np.ndarray]], Tuple[int, int, int, int], int]]:
+    # Same as label_polygons, for a label image given as horizontal runs (row, start column, length, label),
+    # e.g. Loon's RLE label files. Bounding boxes and areas come from the runs themselves and each label is
+    # only rasterized inside its own bounding box, so memory follows the runs and the largest label, not the image.
+    # Yields (label, polygons, bbox, area) in increasing label order; label 0 is background.
+    rows, starts, lengths, labels = (np.asarray(values, dtype=np.int64) for values in (rows, starts, lengths, labels))
+    keep = (labels != 0) & (lengths > 0)
+    rows, starts, lengths, labels = rows[keep], starts[keep], lengths[keep], labels[keep]
+    order = np.argsort(labels, kind='stable')
+    rows, starts, lengths, labels = rows[order], starts[order], lengths[order], labels[order]
+    group_starts = np.flatnonzero(np.diff(labels)) + 1
+    for group in np.split(np.arange(len(labels)), group_starts):
+        if len(group) == 0:
+            continue
+        group_rows, group_starts_x, group_lengths = rows[group], starts[group], lengths[group]
+        xmin, ymin = int(group_starts_x.min()), int(group_rows.min())
+        xmax, ymax = int((group_starts_x + group_lengths).max()) - 1, int(group_rows.max())
+        # pixels of every run, padded by one pixel like label_polygons' crops
+        run_offsets = np.repeat(np.cumsum(group_lengths) - group_lengths, group_lengths)
+        pixel_columns = np.repeat(group_starts_x, group_lengths) + np.arange(int(group_lengths.sum())) - run_offsets
+        crop = np.zeros((ymax - ymin + 3, xmax - xmin + 3), dtype=np.uint8)
+        crop[np.repeat(group_rows, group_lengths) - ymin + 1, pixel_columns - xmin + 1] = 1
+        yield int(labels[group[0]]), _trace_mask(crop, xmin, ymin), (xmin, ymin, xmax, ymax), int(crop.sum())
+
+# TrackMate spot tables follow the column names with three more header rows (name, short name, units)
+TRACKMATE_HEADER_ROWS = [1, 2, 3]
+
+def read_trackmate_csv(filename: str, dtype: dict = None, exclude_columns: List[str] = []) -> pd.DataFrame:
+    # Skips the extra header rows while parsing, so column types are inferred from the data rows only
+    return pd.read_csv(filename, skiprows=TRACKMATE_HEADER_ROWS, dtype=dtype, usecols=lambda column: column not in exclude_columns)
+
+def strip_extension(values: pd.Series) -> pd.Series:
+    # Vectorized os.path.splitext(value)[0]
+    return values.str.replace(r'^(.*?[^./][^/]*?)\.[^./]*$', r'\1', regex=True)
+
+def unified_schema(schemas: List[pa.Schema]) -> pa.Schema:
+    # Schema holding the columns of every schema, each widened to a type all of them cast to (int32 and int64
+    # to int64, int64 and double to double, float and double to double). Dictionary columns get int32 indices,
+    # so the values of all the tables fit whatever index type each table was written with.
+    schema = pa.unify_schemas([s.remove_metadata() for s in schemas], promote_options='permissive')
+    for i, field in enumerate(schema):
+        if pa.types.is_dictionary(field.type):
+            schema = schema.set(i, field.with_type(pa.dictionary(pa.int32(), field.type.value_type, field.type.ordered)))
+    return schema
+
+def conform_table(table: pa.Table, schema: pa.Schema) -> pa.Table:
+    # Orders and casts the columns of table to match schema, adding missing columns as nulls
+    extra_columns = set(table.column_names) - set(schema.names)
+    if extra_columns:
+        raise ValueError('Columns not in the output schema: {}'.format(sorted(extra_columns)))
+    columns = []
+    for field in schema:
+        if field.name in table.column_names:
+            columns.append(table.column(field.name).cast(field.type))
+        else:
+            columns.append(pa.nulls(table.num_rows, field.type))
+    return pa.Table.from_arrays(columns, schema=schema)
+
+def compact_table(df: pd.DataFrame, categorical_columns: List[str] = [], tolerance: float = 0.0, downcast_integers: bool = True) -> pd.DataFrame:
+    # Smaller encodings for the columns of a table, which Parquet keeps (categories as dictionary columns):
+    # - categorical_columns, e.g. labels repeated on every row of a track, become categoricals
+    # - float64 columns become float32 when no value moves by more than tolerance (0 keeps them exact)
+    # - with downcast_integers, integer columns, and float columns holding only whole numbers, become the
+    #   smallest integer type that holds them. Tables that are combined later should keep their integer types,
+    #   as the smallest type can differ from one table to the next.
+    df = df.copy()
+    for column in df.columns:
+        values = df[column]
+        if column in categorical_columns:
+            df[column] = values.astype('category')
+        elif pd.api.types.is_bool_dtype(values) or not pd.api.types.is_numeric_dtype(values):
+            continue
+        elif pd.api.types.is_integer_dtype(values):
+            if downcast_integers:
+                df[column] = pd.to_numeric(values, downcast='integer')
+        elif values.dtype.itemsize > 4:
+            array = values.to_numpy()
+            finite = np.isfinite(array)
+            if downcast_integers and len(array) > 0 and finite.all() and np.all(np.abs(array) < 2 ** 53) and np.array_equal(array, np.trunc(array)):
+                df[column] = pd.to_numeric(array.astype(np.int64), downcast='integer')
+                continue
+            compact = array.astype(np.float32)
+            if np.array_equal(np.isfinite(compact), finite) and np.all(np.abs(compact[finite] - array[finite]) <= tolerance):
+                df[column] = compact
+    return df
+
+DATASET_ROW_GROUP_SIZE = 64 * 1024
+FRAME_BUCKET_COLUMN = 'frame_bucket'
+
+def write_partitioned_dataset(table: pa.Table, root: str, location_column: str = 'location', frame_column: str = None,
+                              frame_bucket_size: int = 0, basename: str = 'part', row_group_size: int = DATASET_ROW_GROUP_SIZE) -> List[str]:
+    # Writes table as a hive partitioned Parquet dataset, root/{location_column}={location}/{basename}-0.parquet,
+    # with a frame_bucket={first frame} level below it when frame_bucket_size is set. Rows are sorted by location
+    # and frame, row groups hold at most row_group_size rows, and every file has column statistics and page
+    # indexes, so a reader filtering on a location, a frame range or any column skips what it does not need.
+    # Files of the same basename from an earlier run are removed first, wherever they are under root, so no stale
+    # file is left when the bucket size changes or a location no longer has rows in a bucket. Returns the paths
+    # of the files written.
+    if isinstance(table, pd.DataFrame):
+        table = pa.Table.from_pandas(table, preserve_index=False)
+    sort_columns = [location_column] + ([frame_column] if frame_column else [])
+    table = table.sort_by([(column, 'ascending') for column in sort_columns])
+    table = table.set_column(table.schema.get_field_index(location_column), location_column, whole_number_values(table.column(location_column)))
+    partition_columns = [location_column]
+    if frame_bucket_size:
+        frames = table.column(frame_column).to_numpy()
+        table = table.append_column(FRAME_BUCKET_COLUMN, whole_number_values(pa.array(frames // frame_bucket_size * frame_bucket_size)))
+        partition_columns.append(FRAME_BUCKET_COLUMN)
+    remove_dataset_files(root, basename)
+    written = []
+    file_options = ds.ParquetFileFormat().make_write_options(write_statistics=True, write_page_index=True)
+    ds.write_dataset(table, root, format='parquet', file_options=file_options,
+                     partitioning=partition_columns, partitioning_flavor='hive', basename_template=basename + '-{i}.parquet',
+                     max_rows_per_group=row_group_size, min_rows_per_group=min(row_group_size, max(1, table.num_rows)),
+                     existing_data_behavior='overwrite_or_ignore', file_visitor=lambda written_file: written.append(written_file.path))
+    return written
+
+def whole_number_values(values: Union[pa.Array, pa.ChunkedArray]) -> Union[pa.Array, pa.ChunkedArray]:
+    # Float values that are all whole numbers as int64, e.g. a location read as float because of missing values,
+    # so they name partition folders location=1 rather than location=1.0. Other values are returned as they are.
+    if not pa.types.is_floating(values.type):
+        return values
+    try:
+        return values.cast(pa.int64())
+    except pa.ArrowInvalid:
+        return values
+
+def remove_dataset_files(root: str, basename: str):
+    # Removes the {basename}-{i}.parquet files under root, and the partition folders they leave empty
+    if not os.path.isdir(root):
+        return
+    for folder, _, filenames in os.walk(root, topdown=False):
+        for filename in filenames:
+            if filename.startswith(basename + '-') and filename.endswith('.parquet') and filename[len(basename) + 1:-len('.parquet')].isdigit():
+                os.remove(os.path.join(folder, filename))
+        if folder != root and not os.listdir(folder):
+            os.rmdir(folder)
+
+MANIFEST_FILENAME = 'conversion_manifest.json'
+HASH_SIZE_LIMIT = 64 * 1024 * 1024 # larger inputs are compared by size and mtime only
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha1()
+    with open(path, 'rb') as in_file:
+        for block in iter(lambda: in_file.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def array_digest(*arrays: np.ndarray) -> str:
+    # Content hash of numeric arrays, for units of work whose input is part of a larger file
+    digest = hashlib.sha1()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update('{}{}'.format(array.dtype.str, array.shape).encode())
+        digest.update(array.data)
+    return digest.hexdigest()
+
+class ConversionManifest:
+    '''
+    Persisted record of the inputs each unit of work (a frame, a location, ...) was converted from
+    and of the outputs it produced. Re-runs skip the units whose inputs are unchanged and whose outputs
+    still exist, and an interrupted run resumes from the last saved record. Units converted with
+    different output settings (e.g. coordinate precision) are not current.
+    '''
+    def __init__(self, filename: str, save_every: int = 100, settings: dict = None):
+        self.filename = filename
+        self.settings = settings
+        self.save_every = save_every
+        self.unsaved_count = 0
+        self.entries = {}
+        if os.path.exists(filename):
+            with open(filename) as in_file:
+                self.entries = json.load(in_file).get('entries', {})
+
+    def is_current(self, key: str, input_paths: List[str] = [], extra: str = None) -> bool:
+        entry = self.entries.get(key)
+        if entry is None or entry['extra'] != extra or entry.get('settings') != self.settings or sorted(entry['inputs']) != sorted(input_paths):
+            return False
+        for path in input_paths:
+            recorded = entry['inputs'][path]
+            if not os.path.exists(path):
+                return False
+            stat = os.stat(path)
+            if stat.st_size != recorded['size']:
+                return False
+            if stat.st_mtime_ns != recorded['mtime']:
+                # touched, but the content may be the same
+                if recorded['sha1'] is None or stat.st_size > HASH_SIZE_LIMIT or file_digest(path) != recorded['sha1']:
+                    return False
+                recorded['mtime'] = stat.st_mtime_ns
+        return all(os.path.exists(path) for path in entry['outputs'])
+
+    def record(self, key: str, input_paths: List[str], output_paths: List[str], extra: str = None):
+        previous = self.entries.get(key, {})
+        previous_inputs = previous.get('inputs', {})
+        # remove the outputs of the last run that this one no longer produces
+        for path in set(previous.get('outputs', [])) - set(output_paths):
+            if os.path.exists(path):
+                os.remove(path)
+        inputs = {}
+        for path in input_paths:
+            stat = os.stat(path)
+            fingerprint = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha1': None}
+            recorded = previous_inputs.get(path)
+            if recorded is not None and recorded['size'] == stat.st_size and recorded['mtime'] == stat.st_mtime_ns:
+                fingerprint['sha1'] = recorded['sha1']
+            elif stat.st_size <= HASH_SIZE_LIMIT:
+                fingerprint['sha1'] = file_digest(path)
+            inputs[path] = fingerprint
+        self.entries[key] = {'inputs': inputs, 'outputs': list(output_paths), 'extra': extra, 'settings': self.settings}
+        self.unsaved_count += 1
+        if self.unsaved_count >= self.save_every:
+            self.save()
+
+    def save(self):
+        # written to a temporary file first so an interrupted save keeps the previous manifest
+        ensure_directory_exists(self.filename)
+        temp_filename = self.filename + '.tmp'
+        with open(temp_filename, 'w') as out_file:
+            json.dump({'version': 1, 'entries': self.entries}, out_file)
+        os.replace(temp_filename, self.filename)
+        self.unsaved_count = 0